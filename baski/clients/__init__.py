@@ -1,2 +1,3 @@
 from .openai_client import *
-from .scrapfly_client import *
\ No newline at end of file
+from .scrapfly_client import *
+from .token_counter import *
@@ -7,18 +7,44 @@ from copy import deepcopy
 
 import aiohttp
 import openai
-import tiktoken
 from openai.openai_object import OpenAIObject
 
 from baski import env, monitoring, pattern
+from .token_counter import TokenCounter
 
 __all__ = ["OpenAiClient"]
 
 OPENAI_INPUT_TEXT = "openai_in_text"
 OPENAI_OUTPUT_TEXT = "openai_out_text"
 
+YIELD_CUMULATIVE = "cumulative"
+YIELD_DELTA = "delta"
+
 
 class OpenAiClient(object):
+    # Context window by model name or prefix, history of other models is sent as is
+    context_windows = {
+        'gpt-3.5-turbo': 16385,
+        'gpt-3.5-turbo-instruct': 4096,
+        'gpt-4': 8192,
+        'gpt-4-32k': 32768,
+        'gpt-4-turbo': 128000,
+        'gpt-4-1106': 128000,
+        'gpt-4-0125': 128000,
+        'gpt-4o': 128000,
+        'gpt-4.1': 1047576,
+        'o1': 200000,
+        'o3': 200000,
+        'o4': 200000,
+    }
+    # Tokens kept for the answer when max_tokens is not set
+    output_reserve = 1024
+    # Chat format tokens per message and for the answer priming
+    message_overhead = 4
+    reply_overhead = 3
+    # Oldest kept turn is truncated to the rest of the budget only when at least that much is left
+    min_truncated_tokens = 64
+
     _retry_exceptions = (
         openai.error.APIError,
         openai.error.Timeout,
@@ -35,16 +61,21 @@ class OpenAiClient(object):
             user_prompts=None,
             default_cgi=None,
             chunk_length=128,
-            telemetry: monitoring.Telemetry=None
+            telemetry: monitoring.Telemetry=None,
+            token_counter: TokenCounter = None
     ):
         openai.api_key = api_key
         self.system_prompt = system_prompt or ""
         self.user_prompts = user_prompts or {}
         self.default_cgi = default_cgi or _CGI
         self.chunk_length = chunk_length
-        self.token_encoder = tiktoken.get_encoding("cl100k_base")
+        self.token_counter = token_counter or TokenCounter.shared()
         self.telemetry = telemetry
 
+    @property
+    def token_encoder(self):
+        return self.token_counter.encoder(self.default_cgi.get('model', 'undefined'))
+
     async def transcribe(self, user_id, audio: io.FileIO) -> typing.AnyStr:
         result = await pattern.retry(
             openai.Audio.atranscribe,
@@ -53,22 +84,31 @@ class OpenAiClient(object):
             model="whisper-1", file=audio
         )
         text = result['text']
-        self._log_response(user_id, text, "transcribe", "whisper-1")
+        await self._log_response(user_id, text, "transcribe", "whisper-1")
         return text
 
-    def from_prompt(self, user_id, prompt, history=None, prepend=False, streaming=True, **params):
+    def from_prompt(
+            self, user_id, prompt, history=None, prepend=False, streaming=True, yield_mode=YIELD_CUMULATIVE, **params
+    ):
         if streaming:
-            return self.from_prompt_streaming(user_id, prompt, history, prepend, **params)
+            return self.from_prompt_streaming(user_id, prompt, history, prepend, yield_mode, **params)
         else:
             return self.from_prompt_gather(user_id, prompt, history, prepend, **params)
 
     async def from_prompt_gather(self, user_id, prompt, history=None, prepend=False, **params):
-        result = None
-        async for chunk in self.from_prompt_streaming(user_id, prompt, history, prepend, **params):
-            result = chunk
-        return result
+        # Cumulative mode restarts the answer on retry, so a stream that breaks midway is retried
+        text = None
+        async for text in self.from_prompt_streaming(user_id, prompt, history, prepend, YIELD_CUMULATIVE, **params):
+            pass
+        return text
 
-    def from_prompt_streaming(self, user_id, prompt, history=None, prepend=False, **params):
+    def from_prompt_streaming(
+            self, user_id, prompt, history=None, prepend=False, yield_mode=YIELD_CUMULATIVE, **params
+    ):
+        """
+        yield_mode cumulative yields the whole text so far, delta yields only the text added since the last yield
+        """
+        assert yield_mode in (YIELD_CUMULATIVE, YIELD_DELTA), f"Unknown yield mode {yield_mode}"
         history = [_check_message(msg) for msg in history or []]
         prompt_text, prompt_cfg, request_id = self._get_prompt_text_cfg(prompt, **params)
 
@@ -77,6 +117,8 @@ class OpenAiClient(object):
             user_id=user_id,
             history=[message] + history if prepend else history + [message],
             request_id=request_id,
+            yield_mode=yield_mode,
+            prepend=prepend,
             **prompt_cfg
         )
 
@@ -92,11 +134,22 @@ class OpenAiClient(object):
             prompt_text = prompt
         return prompt_text, prompt_cfg, request_id
 
-    async def _create_message(self, user_id, history, request_id, **params):
+    async def _create_message(
+            self, user_id, history, request_id, yield_mode=YIELD_CUMULATIVE, prepend=False, **params
+    ):
+        """
+        The new message is the last one in history or the first one with prepend, older turns may be dropped
+        to fit the context window of the model
+        """
         assert isinstance(history, list)
-        messages = [_from_system(self.system_prompt)] + history
+        system = _from_system(self.system_prompt)
         this_cgi = self.default_cgi.copy() | params
-        self._log_request(user_id, messages, request_id, this_cgi.get('model', 'undefined'))
+        model = this_cgi.get('model', 'undefined')
+        history, packing = await self._pack_history(system, history, prepend, model, this_cgi.get('max_tokens'))
+        messages = [system] + history
+        await self._log_request(user_id, messages, request_id, model, **packing)
+        delta_mode = yield_mode == YIELD_DELTA
+        yielded_any = False
         for i in range(1, 50):
             try:
                 this_cgi = self.default_cgi.copy() | params
@@ -106,23 +159,31 @@ class OpenAiClient(object):
                     stream=True,
                     **this_cgi
                 )
-                chunks = []
-                yielded_text = ""
+                # Text is assembled from pending chunks only when it is yielded, sizes are tracked incrementally
+                parts, text, pending, pending_size = [], "", [], 0
                 async for chunk in response:
                     if chunk['choices'][0]['finish_reason'] == "stop":
                         break
                     delta = chunk['choices'][0]['delta']
                     logging.debug(f"new chunk: {delta.get('content', '')}")
                     content = delta.get('content', '')
-                    chunks.append(content)
-                    size_so_far = sum(len(c) for c in chunks)
-                    if '\n' in content or size_so_far - len(yielded_text) > self.chunk_length:
-                        yielded_text = ''.join(chunks)
-                        yield yielded_text
-                final_text = ''.join(chunks)
-                if final_text != yielded_text:
-                    yield final_text
-                self._log_response(user_id, final_text, request_id, this_cgi.get('model', 'undefined'))
+                    pending.append(content)
+                    pending_size += len(content)
+                    if '\n' in content or pending_size > self.chunk_length:
+                        added = ''.join(pending)
+                        parts.append(added)
+                        pending, pending_size = [], 0
+                        yielded_any = True
+                        if delta_mode:
+                            yield added
+                        else:
+                            text += added
+                            yield text
+                if pending_size:
+                    added = ''.join(pending)
+                    parts.append(added)
+                    yield added if delta_mode else text + added
+                await self._log_response(user_id, ''.join(parts), request_id, this_cgi.get('model', 'undefined'))
                 return
             except openai.error.InvalidRequestError as e:
                 raise
@@ -133,6 +194,9 @@ class OpenAiClient(object):
                     json.decoder.JSONDecodeError,
                     aiohttp.ClientError,
                     asyncio.exceptions.TimeoutError) as e:
+                if delta_mode and yielded_any:
+                    # Consumer has appended part of the answer, a new answer can't continue it
+                    raise
                 logging.warning(f"{i} Get {type(e)} exception from OpenAI: {e}")
                 try:
                     await asyncio.sleep(i)
@@ -141,7 +205,43 @@ class OpenAiClient(object):
                     return
         raise RuntimeError("OpenAI is not available")
 
-    def _log_request(self, user_id, messages, request_id, model):
+    async def _pack_history(self, system, history, prepend, model, max_tokens=None):
+        """
+        Drops the oldest turns that don't fit the context window and truncates the oldest kept one.
+        System prompt and the new message are always kept. Counts are cached, so only new messages are encoded
+        """
+        window = _by_prefix(self.context_windows, model)
+        if not window or len(history) < 2:
+            return history, {}
+
+        message, turns = (history[0], history[1:]) if prepend else (history[-1], history[:-1])
+        counts = await self.token_counter.count_many(
+            [system['content'], message['content']] + [turn['content'] for turn in turns], model)
+        available = window - (max_tokens or self.output_reserve) - self.reply_overhead \
+            - counts[0] - counts[1] - 2 * self.message_overhead
+
+        kept = []
+        for turn, tokens in zip(reversed(turns), reversed(counts[2:])):
+            if tokens + self.message_overhead <= available:
+                kept.append(turn)
+                available -= tokens + self.message_overhead
+                continue
+            if available - self.message_overhead >= self.min_truncated_tokens:
+                content = await self.token_counter.truncate(turn['content'], available - self.message_overhead, model)
+                kept.append({'role': turn['role'], 'content': content})
+            break
+        if len(kept) == len(turns) and (not kept or kept[-1] is turns[0]):
+            return history, {}
+
+        kept.reverse()
+        saved = sum(counts[2:]) + self.message_overhead * len(turns) \
+            - sum(await self.token_counter.count_many([turn['content'] for turn in kept], model)) \
+            - self.message_overhead * len(kept)
+        packing = {'history_tokens_saved': saved, 'history_turns_dropped': len(turns) - len(kept)}
+        logging.debug(f"History for {model} is packed: {packing}")
+        return ([message] + kept if prepend else kept + [message]), packing
+
+    async def _log_request(self, user_id, messages, request_id, model, **packing):
         if not self.telemetry:
             return
         self.telemetry.add(
@@ -149,12 +249,12 @@ class OpenAiClient(object):
             event_type=OPENAI_INPUT_TEXT,
             payload={
                 "request_id": request_id,
-                "tokens": sum([len(self.token_encoder.encode(msg['content'])) for msg in messages]),
+                "tokens": await self.token_counter.count_messages(messages, model),
                 "model": model
-            }
+            } | packing
         )
 
-    def _log_response(self, user_id, text, request_id, model):
+    async def _log_response(self, user_id, text, request_id, model):
         if not self.telemetry:
             return
         self.telemetry.add(
@@ -162,12 +262,19 @@ class OpenAiClient(object):
             event_type=OPENAI_OUTPUT_TEXT,
             payload={
                 "request_id": request_id,
-                "tokens": len(self.token_encoder.encode(text)),
+                "tokens": (await self.token_counter.count_many([text], model))[0],
                 "model": model
             }
         )
 
 
+def _by_prefix(values: typing.Dict[str, typing.Any], model: str):
+    for prefix in sorted(values, key=len, reverse=True):
+        if model.startswith(prefix):
+            return values[prefix]
+    return None
+
+
 def _check_message(msg):
     assert isinstance(msg, dict), f"Message must be dict, got {type(msg)}"
     assert set(msg.keys()) == {"role", "content"}, f"Message must have keys 'role' and 'content', got {msg.keys()}"
@@ -1,28 +1,69 @@
+import asyncio
+import random
 import typing
+from collections import defaultdict
 from http import HTTPStatus
 
 import aiohttp
 from yarl import URL
-from baski.http import HttpClient, HttpException
+from baski.concurrent import PrioritySemaphore
+from baski.http import HttpClient, HttpException, HttpTimeoutError
+from baski.primitives.lru import LruCache
 
 
 __all__ = ['ScrapflyClient']
 
+# (asp, render_js) from the cheapest to the most expensive
+_TIERS = [('false', 'false'), ('false', 'true'), ('true', 'true')]
+_TIER_NAMES = ['plain', 'render_js', 'asp+render_js']
+
 
 class ScrapflyClient(HttpClient):
+    '''
+    Scrapes through Scrapfly, trying tiers from the cheapest one
+    1. Tier that worked for the domain is remembered for tier_ttl and the next page starts from it
+    2. With reprobe_rate probability a remembered domain starts from one tier cheaper
+    3. Attempts, successes and estimated credits per tier are in stats
+    4. Calls take one of concurrency slots shared by clients of the account, interactive callers go first.
+       Concurrency errors of Scrapfly halve the slots and the call is retried after a backoff,
+       every success adds one slot back up to concurrency
+    '''
+
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_BATCH = 10
+
+    concurrency = 5
+    throttle_retries = 5
+    backoff_base = 1.0
+    backoff_max = 30.0
+
+    tier_ttl = 24 * 60 * 60
+    tier_memory_size = 4096
+    reprobe_rate = 0.05
+    # Estimated credits of a tier call, adjust to the plan
+    tier_credits = (1, 5, 30)
+
+    # Built on first use for every class, so subclasses may change tier_memory_size
+    _tier_memory: typing.Optional[LruCache] = None
+    stats: typing.Dict[str, typing.Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    _slots: typing.Dict[typing.Tuple[str, str], PrioritySemaphore] = {}
 
-    def __init__(self, api_key, req_interval_sec=5.0, **kwargs):
-        for f in ['base_url', 'timeout', 'proxy', 'req_interval_sec']:
+    def __init__(
+            self, api_key, req_interval_sec=0.0, base_url="https://api.scrapfly.io", concurrency=None, **kwargs
+    ):
+        for f in ['timeout', 'proxy', 'req_interval_sec']:
             if f in kwargs:
                 kwargs.pop(f)
 
         super().__init__(
-            base_url="https://api.scrapfly.io",
+            base_url=base_url,
             req_interval_sec=req_interval_sec,
             timeout=aiohttp.ClientTimeout(total=160)
         )
 
         self._api_key = api_key
+        self.concurrency = concurrency or self.concurrency
+        self.slots = self._slots.setdefault((base_url, api_key), PrioritySemaphore(self.concurrency))
 
     async def request(
             self,
@@ -33,25 +74,68 @@ class ScrapflyClient(HttpClient):
             max_attempts=2,
             fail_fast=False,
             render_js=None,
+            priority=PRIORITY_INTERACTIVE,
             **cgi):
-        tries = [('false', 'true', False), ('true', 'true', True)]
-        if render_js is None:
-            tries = [('false', 'false', False)] + tries
+        domain = URL(url).host
+        floor = 0 if render_js is None else 1
+        first = floor
+        remembered = self.tier_memory().get(domain)
+        if remembered is not None:
+            self.stats['memory']['hits'] += 1
+            first = max(first, remembered)
+            if first > floor and random.random() < self.reprobe_rate:
+                self.stats['memory']['reprobes'] += 1
+                first -= 1
+
         result = {}
-        for asp, js, last in tries:
-            data = await super().request(
-                session,
-                URL("/scrape").update_query({
-                    'url': str(URL(url).update_query(cgi)),
-                    'key': self._api_key, 'asp': str(asp), 'render_js': str(js),
-                    'country': 'us,ca'
-                }),
-                method,
-                data,
-                max_attempts=0,
-                fail_fast=fail_fast
-            )
-            result = data.get('result')
+        for tier in range(first, len(_TIERS)):
+            asp, js = _TIERS[tier]
+            stats = self.stats[_TIER_NAMES[tier]]
+            stats['attempts'] += 1
+            stats['credits'] += self.tier_credits[tier]
+            response = await self._scrape(session, URL("/scrape").update_query({
+                'url': str(URL(url).update_query(cgi)),
+                'key': self._api_key, 'asp': str(asp), 'render_js': str(js),
+                'country': 'us,ca'
+            }), method, data, fail_fast, priority)
+            result = response.get('result')
             if result['success']:
+                stats['successes'] += 1
+                self.tier_memory().set(domain, tier, ttl=self.tier_ttl)
                 return result
         self.raise_for_status(result.get("status_code", HTTPStatus.IM_A_TEAPOT), result.get('reason', 'Unknown reason'))
+
+    async def _scrape(self, session, url, method, data, fail_fast, priority):
+        for attempt in range(self.throttle_retries + 1):
+            async with self.slots.slot(priority):
+                try:
+                    response = await super().request(session, url, method, data, max_attempts=0, fail_fast=fail_fast)
+                except HttpTimeoutError as e:
+                    if fail_fast or e.code != HTTPStatus.TOO_MANY_REQUESTS or attempt == self.throttle_retries:
+                        raise
+                    self.stats['slots']['throttled'] += 1
+                    self.slots.limit = self.slots.limit // 2
+                else:
+                    if self.slots.limit < self.concurrency:
+                        self.slots.limit += 1
+                    return response
+            await asyncio.sleep(min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1))
+
+    @classmethod
+    def tier_memory(cls) -> LruCache:
+        if cls.__dict__.get('_tier_memory') is None:
+            cls._tier_memory = LruCache(maxsize=cls.tier_memory_size, ttl=cls.tier_ttl)
+        return cls._tier_memory
+
+    @classmethod
+    def tier_stats(cls) -> typing.Dict[str, typing.Dict[str, float]]:
+        """
+        Counters per tier with success rate and credits per success
+        """
+        result = {}
+        for name, stats in cls.stats.items():
+            result[name] = dict(stats)
+            if 'attempts' in stats:
+                result[name]['success_rate'] = stats['successes'] / stats['attempts']
+                result[name]['credits_per_success'] = stats['credits'] / max(stats['successes'], 1)
+        return result
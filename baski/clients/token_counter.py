@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import typing
+
+import tiktoken
+
+from baski.concurrent import as_async
+from baski.primitives.lru import LruCache
+
+__all__ = ['TokenCounter']
+
+_DEFAULT_ENCODING = "cl100k_base"
+
+
+class TokenCounter(object):
+    '''
+    Counts tokens of texts for a model
+    1. Encoder is chosen by model: registered ones first, then tiktoken, then cl100k_base
+    2. Counts are cached by content hash, unchanged history messages are never encoded again
+    3. Uncached texts longer than offload_chars in total are encoded in a worker thread
+    '''
+
+    offload_chars = 16 * 1024
+
+    # Model name or prefix to encoding name or encoder object with encode() and name
+    _registry: typing.Dict[str, typing.Any] = {}
+    _encoders: typing.Dict[str, typing.Any] = {}
+    _shared: typing.Optional['TokenCounter'] = None
+
+    def __init__(self, maxsize=16384):
+        self._counts = LruCache(maxsize=maxsize)
+
+    @classmethod
+    def shared(cls) -> 'TokenCounter':
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    @classmethod
+    def register(cls, model: str, encoding: typing.Union[str, typing.Any]):
+        """
+        Model is an exact name or a prefix, e.g. 'gpt-4o' covers 'gpt-4o-mini'
+        """
+        cls._registry[model] = encoding
+        cls._encoders.clear()
+
+    @classmethod
+    def encoder(cls, model: str):
+        encoder = cls._encoders.get(model)
+        if encoder is None:
+            encoder = cls._encoders[model] = cls._resolve(model)
+        return encoder
+
+    @classmethod
+    def _resolve(cls, model: str):
+        for prefix in sorted(cls._registry, key=len, reverse=True):
+            if model.startswith(prefix):
+                encoding = cls._registry[prefix]
+                return tiktoken.get_encoding(encoding) if isinstance(encoding, str) else encoding
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            logging.info(f"No tokenizer for model {model}, {_DEFAULT_ENCODING} is used")
+            return tiktoken.get_encoding(_DEFAULT_ENCODING)
+
+    def count(self, text: str, model: str) -> int:
+        encoder = self.encoder(model)
+        key = self._key(encoder, text)
+        n = self._counts.get(key)
+        if n is None:
+            n = len(encoder.encode(text))
+            self._counts.set(key, n)
+        return n
+
+    async def count_many(self, texts: typing.Sequence[str], model: str) -> typing.List[int]:
+        # tiktoken may download encoding files on first use
+        encoder = self._encoders.get(model) or await as_async(self.encoder, model)
+        keys = [self._key(encoder, text) for text in texts]
+        counts = [self._counts.get(key) for key in keys]
+        missing = [i for i, c in enumerate(counts) if c is None]
+        if not missing:
+            return counts
+
+        uncached = [texts[i] for i in missing]
+        if sum(len(t) for t in uncached) > self.offload_chars:
+            encoded = await as_async(_encode_lengths, encoder, uncached)
+        else:
+            encoded = _encode_lengths(encoder, uncached)
+        for i, n in zip(missing, encoded):
+            counts[i] = n
+            self._counts.set(keys[i], n)
+        return counts
+
+    async def truncate(self, text: str, max_tokens: int, model: str) -> str:
+        """
+        Keeps the last max_tokens tokens of the text
+        """
+        encoder = self._encoders.get(model) or await as_async(self.encoder, model)
+        if len(text) > self.offload_chars:
+            return await as_async(_tail, encoder, text, max_tokens)
+        return _tail(encoder, text, max_tokens)
+
+    async def count_messages(self, messages: typing.Iterable[typing.Dict], model: str) -> int:
+        return sum(await self.count_many([msg['content'] for msg in messages], model))
+
+    @staticmethod
+    def _key(encoder, text: str) -> typing.Tuple[str, bytes]:
+        return getattr(encoder, 'name', ''), hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def _encode_lengths(encoder, texts: typing.List[str]) -> typing.List[int]:
+    if hasattr(encoder, 'encode_batch') and len(texts) > 1:
+        return [len(tokens) for tokens in encoder.encode_batch(texts)]
+    return [len(encoder.encode(text)) for text in texts]
+
+
+def _tail(encoder, text: str, max_tokens: int) -> str:
+    tokens = encoder.encode(text)
+    return encoder.decode(tokens[-max_tokens:]) if max_tokens > 0 else ""
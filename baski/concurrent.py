@@ -1,5 +1,9 @@
 import asyncio
+import contextlib
 import functools
+import heapq
+import itertools
+import time
 import typing
 from http import HTTPStatus
 
@@ -7,7 +11,7 @@ from tornado.web import HTTPError
 
 from .config import AppConfig
 
-__all__ = ['as_async', 'map_async', 'as_task']
+__all__ = ['as_async', 'map_async', 'as_task', 'gather_or_cancel', 'RateLimiter', 'PrioritySemaphore']
 
 
 @functools.lru_cache()
@@ -37,3 +41,172 @@ async def as_async(f: typing.Callable, *args, **kwargs):
 
 def as_task(coro):
     return asyncio.get_event_loop().create_task(coro)
+
+
+async def gather_or_cancel(aws: typing.Iterable[typing.Awaitable]) -> typing.List:
+    """
+    Like asyncio.gather but the first exception cancels the rest of awaitables and is raised as is
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    for t in tasks:
+        if t.done() and not t.cancelled() and t.exception() is not None:
+            raise t.exception()
+    return [t.result() for t in tasks]
+
+
+class RateLimiter(object):
+    """
+    Token bucket in the form of GCRA: rate permits per second with up to burst permits at once.
+    Permits are reserved synchronously, so concurrent callers are served in FIFO order of acquire() calls.
+    Limiters created by shared() with the same key are the same object, e.g. for clients of one upstream.
+    """
+    _shared: typing.Dict[str, 'RateLimiter'] = {}
+
+    def __init__(self, rate: typing.Optional[float], burst: int = 1, clock=time.monotonic):
+        self.rate = float(rate or 0)
+        self.burst = max(int(burst or 1), 1)
+        self._clock = clock
+        self._tat = clock()  # theoretical arrival time of the next permit
+        self._waiting = 0
+        self._acquired = 0
+        self._delayed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @classmethod
+    def shared(cls, key: str, rate: typing.Optional[float], burst: int = 1) -> 'RateLimiter':
+        if key not in cls._shared:
+            cls._shared[key] = cls(rate, burst)
+        return cls._shared[key]
+
+    @property
+    def interval(self) -> float:
+        return 1.0 / self.rate if self.rate > 0 else 0.0
+
+    def reserve(self) -> float:
+        """
+        Reserves a permit and returns seconds to wait before using it
+        """
+        self._acquired += 1
+        if not self.interval:
+            return 0.0
+        now = self._clock()
+        tat = max(self._tat, now)
+        self._tat = tat + self.interval
+        return max(tat - (self.burst - 1) * self.interval - now, 0.0)
+
+    def try_acquire(self) -> bool:
+        """
+        Takes a permit only if it is available right now
+        """
+        if self.interval and self._tat - (self.burst - 1) * self.interval > self._clock():
+            return False
+        self.reserve()
+        return True
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay <= 0:
+            return
+        self._waiting += 1
+        started = self._clock()
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            waited = self._clock() - started
+            self._waiting -= 1
+            self._delayed += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+    def stats(self) -> typing.Dict:
+        """
+        How much callers wait for the limiter, the limiter is the bottleneck when waiting stays high
+        """
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'acquired': self._acquired,
+            'delayed': self._delayed,
+            'waiting': self._waiting,
+            'wait_seconds_total': round(self._wait_total, 3),
+            'wait_seconds_max': round(self._wait_max, 3),
+            'wait_seconds_avg': round(self._wait_total / self._acquired, 3) if self._acquired else 0.0,
+        }
+
+
+class PrioritySemaphore(object):
+    """
+    Semaphore that hands free slots to waiters with the lowest priority value first, FIFO within a priority.
+    limit can be changed at any time, e.g. to back off, slots in use above the limit are not revoked.
+    """
+
+    def __init__(self, limit: int):
+        self._limit = max(int(limit), 1)
+        self._in_use = 0
+        self._waiters: typing.List[typing.Tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @limit.setter
+    def limit(self, value: int):
+        self._limit = max(int(value), 1)
+        self._wake()
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, f in self._waiters if not f.done())
+
+    async def acquire(self, priority=0):
+        if self._in_use < self._limit and not self.waiting:
+            self._in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over right before the cancellation
+                self.release()
+            raise
+
+    def release(self):
+        self._in_use -= 1
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=0):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> typing.Dict:
+        return {'limit': self._limit, 'in_use': self._in_use, 'waiting': self.waiting}
+
+    def _wake(self):
+        while self._waiters and self._in_use < self._limit:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._in_use += 1
+            future.set_result(None)
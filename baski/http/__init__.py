@@ -1,7 +1,14 @@
 from .threads_handler import *
+from .batch_writer import *
 from .client import *
 from .exceptions import *
+from .metrics import *
+from .metrics_handler import *
 from .ping_handler import *
 from .request_handler import *
+from .response_cache import *
+from .session_pool import *
+from .stand_in import *
 from .stop_handler import *
 from .queue_update_handler import *
+from .queue_update_subscriber import *
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import typing
+from collections import defaultdict
+
+from google.cloud import firestore
+
+__all__ = ['FirestoreBatchWriter']
+
+# Firestore rejects batched writes with more operations
+MAX_BATCH_SIZE = 500
+
+
+class FirestoreBatchWriter(object):
+    '''
+    Coalesces document writes into firestore batched writes.
+    1. Buffered writes are committed every max_batch_size writes or flush_interval seconds
+    2. flush() commits the rest and raises the first commit error if any
+    3. metrics holds written documents, committed batches and the largest batch size
+    '''
+
+    def __init__(self, db: firestore.AsyncClient, max_batch_size=MAX_BATCH_SIZE, flush_interval=1.0, prefix=''):
+        self.db = db
+        self.max_batch_size = max(min(int(max_batch_size), MAX_BATCH_SIZE), 1)
+        self.flush_interval = flush_interval
+        self.metrics = defaultdict(int)
+        self._prefix = prefix
+        self._buffer = []
+        self._timer: typing.Optional[asyncio.TimerHandle] = None
+        self._commits = set()
+        self._errors = []
+
+    async def set(self, reference: firestore.AsyncDocumentReference, data: typing.Dict, merge=True):
+        self._buffer.append((reference, data, merge))
+        if len(self._buffer) >= self.max_batch_size:
+            await self._commit(self._take_buffer())
+        elif self._timer is None and self.flush_interval:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._commit_in_background)
+
+    async def flush(self):
+        writes = self._take_buffer()
+        if writes:
+            await self._commit(writes)
+        if self._commits:
+            await asyncio.gather(*self._commits, return_exceptions=True)
+        if self._errors:
+            error, self._errors = self._errors[0], []
+            raise error
+
+    def _take_buffer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        writes, self._buffer = self._buffer, []
+        return writes
+
+    def _commit_in_background(self):
+        self._timer = None
+        task = asyncio.ensure_future(self._commit_or_keep_error(self._take_buffer()))
+        self._commits.add(task)
+        task.add_done_callback(self._commits.discard)
+
+    async def _commit_or_keep_error(self, writes):
+        try:
+            await self._commit(writes)
+        except Exception as e:
+            logging.warning(f"Failed to commit {len(writes)} buffered writes: {e}")
+            self._errors.append(e)
+
+    async def _commit(self, writes):
+        if not writes:
+            return
+        batch = self.db.batch()
+        for reference, data, merge in writes:
+            batch.set(reference, data, merge=merge)
+        await batch.commit()
+        self.metrics[f'{self._prefix}writes'] += len(writes)
+        self.metrics[f'{self._prefix}batches'] += 1
+        key = f'{self._prefix}batch_max'
+        self.metrics[key] = max(self.metrics[key], len(writes))
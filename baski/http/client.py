@@ -1,10 +1,17 @@
 import asyncio
+import contextlib
+import contextvars
+import functools
+import io
 import logging
 import pathlib
-import ssl
+import threading
+import time
 import typing
-from datetime import datetime, timedelta
+import uuid
+from collections import defaultdict, deque
 from http import HTTPStatus
+from json import loads as json_loads
 from urllib import parse
 from urllib.parse import urlparse
 
@@ -12,6 +19,10 @@ import aiohttp
 import xmltodict
 
 from .exceptions import *
+from .metrics import HttpMetrics, RequestTrace
+from .response_cache import ResponseCache, CachedResponse
+from .session_pool import SessionPool, ssl_context
+from ..concurrent import RateLimiter, as_async
 from ..env import is_debug, is_test
 from ..primitives import json
 
@@ -32,22 +43,125 @@ CONTENT_TYPE_HTML = 'text/html'
 HttpResult = typing.Optional[typing.Union[typing.Dict, typing.AnyStr]]
 
 
-def get_cipher_list():
-    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-    return [cipher['name'] for cipher in context.get_ciphers()]
+_CACHEABLE_METHODS = (aiohttp.hdrs.METH_GET, aiohttp.hdrs.METH_HEAD)
+_ERROR_MODES = ('raise', 'return', 'skip')
+
+
+class _Call(object):
+    """
+    Options of one fetch and details of its response. It reaches request() through a context variable,
+    so subclasses that override request() keep working
+    """
+    __slots__ = ('headers', 'frame', 'hedge', 'status', 'response_headers', 'size')
+
+    def __init__(self, headers=None, frame: typing.Dict = None, hedge: typing.Union[bool, float] = False):
+        self.headers = headers or {}
+        self.frame = frame
+        self.hedge = hedge
+        self.status = None
+        self.response_headers = None
+        self.size = 0
+
+    def copy(self) -> '_Call':
+        return _Call(self.headers, self.frame, self.hedge)
+
+    def take_response(self, other: '_Call'):
+        self.status, self.response_headers, self.size = other.status, other.response_headers, other.size
+
+
+_current_call: contextvars.ContextVar[typing.Optional[_Call]] = contextvars.ContextVar('http_call', default=None)
+
+
+class _LoopBridge(object):
+    """
+    Lets a worker thread wait for coroutines on the event loop, the worker is paced by the loop.
+    stop() cancels whatever the worker waits for and waits for the worker
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.stopped = threading.Event()
+        self._pending = set()
+
+    def wait(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        self._pending.add(future)
+        if self.stopped.is_set():
+            future.cancel()
+        try:
+            return future.result()
+        finally:
+            self._pending.discard(future)
+
+    async def stop(self, worker: asyncio.Future):
+        self.stopped.set()
+        for future in list(self._pending):
+            future.cancel()
+        await asyncio.wait([worker])
+        if not worker.cancelled():
+            worker.exception()
+
+
+class _BodyReader(io.RawIOBase):
+    """
+    Blocking file-like view of the response body for a worker thread
+    """
+
+    def __init__(self, bridge: _LoopBridge, read_chunk: typing.Callable[[int], typing.Awaitable[bytes]]):
+        super().__init__()
+        self._bridge = bridge
+        self._read_chunk = read_chunk
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self._bridge.wait(self._read_chunk(len(b)))
+        b[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def _read_csv(body, options: typing.Dict):
+    # pandas is slow to import and only CSV consumers need it
+    import pandas
+    return pandas.read_csv(body, **options)
 
 
 class HttpClient(object):
     '''
     Additional functional to the aiohttp.Session
-    1. Open/Close session whenever needed
-    2. Intervals between requests
+    1. Sessions and keep-alive connections are shared between clients through SessionPool
+    2. Rate limit between requests, optionally shared by clients of the same host
     3. Response processing and custom error handle
     4. One time retry for certain statuses
+    5. Optional response cache with conditional revalidation
+    6. Optional single-flight of identical concurrent requests
+    7. Streaming of large bodies, bodies above offload_parse_bytes are decoded in a worker thread
+    8. Optional hedging of slow GET requests, limited to hedge_fraction of them
     '''
 
     _debug = is_debug()
     _unittest = is_test()
+    _in_flight: typing.Dict[typing.Tuple, asyncio.Future] = {}
+    coalesced: typing.Dict[str, int] = defaultdict(int)
+    # Bodies decoded on the event loop and in workers per base url, per request timings are in HttpMetrics
+    parse_stats: typing.Dict[str, typing.Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    offload_parse_bytes = 256 * 1024
+    slow_parse_seconds = 0.1
+    chunk_size = 64 * 1024
+    # Hedging, requests and hedges per host
+    hedge_after: typing.Optional[float] = None
+    hedge_percentile = 95
+    hedge_min_samples = 20
+    hedge_fraction = 0.05
+    hedge_stats: typing.Dict[str, typing.Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    _latency: typing.Dict[str, typing.Deque[float]] = defaultdict(lambda: deque(maxlen=1024))
 
     def __init__(
             self,
@@ -55,16 +169,17 @@ class HttpClient(object):
             req_interval_sec=0.00,
             headers=None,
             proxy=None,
-            timeout=aiohttp.ClientTimeout(total=3 * 60)
+            timeout=aiohttp.ClientTimeout(total=3 * 60),
+            burst=1,
+            rate_limiter: RateLimiter = None,
+            share_rate_limit=False,
+            cache: ResponseCache = None
     ):
-        self._session: aiohttp.ClientSession = None
-        self._ssl_ctx = ssl.create_default_context()
-        self._ssl_ctx.set_ciphers(":".join(get_cipher_list()))
+        self._ssl_ctx = ssl_context()
         self._context_cnt = 0
         self._base_url = base_url
+        self._host = urlparse(base_url).netloc
         self._proxy = proxy
-        self._req_interval = timedelta(seconds=req_interval_sec)
-        self._next_req = datetime.now() + self._req_interval
         self._headers = headers or {}
         for h, v in [(aiohttp.hdrs.USER_AGENT, _UA), (aiohttp.hdrs.CONTENT_TYPE, CONTENT_TYPE_JSON)]:
             if h not in self._headers and h.lower() not in self._headers:
@@ -72,23 +187,21 @@ class HttpClient(object):
         self._timeout = timeout
 
         if self._unittest:
-            self._req_interval = timedelta(seconds=0)
+            req_interval_sec = 0
+        rate = 1 / req_interval_sec if req_interval_sec else None
+        if rate_limiter is None and share_rate_limit:
+            # All clients of the host share one limit
+            rate_limiter = RateLimiter.shared(self._host, rate, burst)
+        self.rate_limiter = rate_limiter or RateLimiter(rate, burst)
+        self.cache = cache
 
     async def __aenter__(self):
+        # Session lifetime is managed by SessionPool, context is kept for backward compatibility
         self._context_cnt += 1
-        if not self._is_session_open():
-            self._session = self._make_session()
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         self._context_cnt -= 1
-        if self._context_cnt == 0 and self._is_session_open():
-            session_to_dispose = self._session
-            self._session = None
-            if session_to_dispose.closed is False:
-                await session_to_dispose.close()
-
-    def _is_session_open(self):
-        return self._session is not None and self._session.closed is False
 
     async def fetch(
             self,
@@ -97,18 +210,183 @@ class HttpClient(object):
             data: typing.Any = None,
             max_attempts=2,
             fail_fast=False,
+            cache_ttl=None,
+            coalesce=False,
+            as_frame: typing.Union[bool, typing.Dict] = False,
+            hedge: typing.Union[bool, float] = False,
             **cgi
     ) -> typing.Union[typing.ByteString, typing.Dict, None]:
-        if self._is_session_open():
-            try:
-                self._context_cnt += 1
-                return await self.request(self._session, url, method, data, max_attempts, fail_fast=fail_fast, **cgi)
-            finally:
-                self._context_cnt -= 1
+        """
+        cache_ttl overrides the cache ttl for this call, 0 bypasses the cache
+        coalesce shares one upstream call between concurrent identical GET and HEAD requests of the process,
+        all callers get the same result object or exception
+        as_frame reads CSV body into pandas.DataFrame in a worker thread while it is downloaded,
+        dict value is passed to pandas.read_csv, e.g. {'dtype': {'close': 'float64'}, 'parse_dates': ['date']}
+        hedge starts the second GET or HEAD when the first one is slower than hedge seconds,
+        True uses hedge_after or hedge_percentile of the host latency. The first response wins
+        """
+        call = _Call(frame=(as_frame if isinstance(as_frame, dict) else {}) if as_frame else None, hedge=hedge)
+        if not coalesce or method not in _CACHEABLE_METHODS:
+            return await self._cached_fetch(call, url, method, data, max_attempts, fail_fast, cache_ttl, **cgi)
+
+        key = (
+            self._base_url, self._proxy, tuple(sorted(self._headers.items())), repr(call.frame),
+            method, str(url), json.dumps(data), tuple(sorted((k, str(v)) for k, v in cgi.items()))
+        )
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self._cached_fetch(call, url, method, data, max_attempts, fail_fast, cache_ttl, **cgi))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced[self._base_url] += 1
+        # Cancelled caller must not cancel the call for the others
+        return await asyncio.shield(task)
+
+    async def fetch_many(
+            self,
+            requests: typing.Iterable[typing.Union[str, typing.Dict]],
+            concurrency: int = None,
+            on_error='raise'
+    ) -> typing.List:
+        """
+        Fetches requests concurrently and returns results in the order of requests,
+        skipped requests leave None in their place. See iter_many for the request format and error modes
+        """
+        requests = list(requests)
+        results = [None] * len(requests)
+        async with contextlib.aclosing(self.iter_many(requests, concurrency, on_error)) as items:
+            async for index, result in items:
+                results[index] = result
+        return results
+
+    async def iter_many(
+            self,
+            requests: typing.Iterable[typing.Union[str, typing.Dict]],
+            concurrency: int = None,
+            on_error='raise'
+    ) -> typing.AsyncIterator[typing.Tuple[int, typing.Any]]:
+        """
+        Yields (index, result) in the order of completion, at most concurrency requests are in flight,
+        SessionPool.limit_per_host by default. Request is an url or fetch() kwargs, 'on_error' key overrides on_error:
+        raise - cancels the rest and raises, return - yields the exception, skip - nothing is yielded.
+        Requests are consumed lazily and go through the client rate limiter
+        """
+        concurrency = concurrency or SessionPool.limit_per_host
+        requests = enumerate(requests)
+        pending: typing.Dict[asyncio.Future, typing.Tuple[int, str]] = {}
+        try:
+            while True:
+                while len(pending) < concurrency and (item := next(requests, None)) is not None:
+                    index, request = item
+                    kwargs = dict(request) if isinstance(request, dict) else {'url': request}
+                    mode = kwargs.pop('on_error', on_error)
+                    assert mode in _ERROR_MODES, f'on_error must be one of {_ERROR_MODES}'
+                    pending[asyncio.ensure_future(self.fetch(**kwargs))] = (index, mode)
+                if not pending:
+                    return
+
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index, mode = pending.pop(task)
+                    if task.exception() is None:
+                        yield index, task.result()
+                    elif mode == 'return':
+                        yield index, task.exception()
+                    elif mode == 'raise':
+                        raise task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _cached_fetch(self, call: '_Call', url, method, data, max_attempts, fail_fast, cache_ttl, **cgi):
+        if self.cache is None or cache_ttl == 0 or method not in _CACHEABLE_METHODS:
+            return await self._fetch(call, url, method, data, max_attempts, fail_fast, **cgi)
+
+        key = self.cache.key(self._base_url, method, url, cgi if call.frame is None else cgi | {'': repr(call.frame)})
+        entry = await self.cache.get(key)
+        if entry is not None and entry.fresh:
+            self.cache.count(self._base_url, 'hit')
+            return entry.result
+
+        if entry is not None:
+            call.headers = entry.conditional_headers()
+        result = await self._fetch(call, url, method, data, max_attempts, fail_fast, **cgi)
+        ttl = self.cache.ttl if cache_ttl is None else cache_ttl
+        if call.status == HTTPStatus.NOT_MODIFIED and entry is not None:
+            self.cache.count(self._base_url, 'revalidated')
+            entry.refresh(ttl)
+            await self.cache.put(key, entry)
+            return entry.result
+
+        self.cache.count(self._base_url, 'miss')
+        if call.status == HTTPStatus.OK:
+            headers = call.response_headers or {}
+            await self.cache.put(key, CachedResponse(
+                result, call.size, ttl,
+                etag=headers.get(aiohttp.hdrs.ETAG),
+                last_modified=headers.get(aiohttp.hdrs.LAST_MODIFIED)
+            ))
+        return result
+
+    async def _fetch(self, call: '_Call', url, method, data, max_attempts, fail_fast, **cgi):
+        if not call.hedge or method not in _CACHEABLE_METHODS:
+            return await self._attempt(call, url, method, data, max_attempts, fail_fast, **cgi)
 
-        session = self._make_session()
-        async with session as session:
-            return await self.request(session, url, method, data, max_attempts, fail_fast=fail_fast, **cgi)
+        stats = self.hedge_stats[self._host]
+        stats['requests'] += 1
+        delay = self._hedge_delay() if call.hedge is True else call.hedge
+        calls = [call.copy()]
+        tasks = [asyncio.ensure_future(self._attempt(calls[0], url, method, data, max_attempts, fail_fast, **cgi))]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+            if pending and stats['hedged'] < self.hedge_fraction * stats['requests']:
+                stats['hedged'] += 1
+                calls.append(call.copy())
+                tasks.append(asyncio.ensure_future(
+                    self._attempt(calls[1], url, method, data, max_attempts, fail_fast, **cgi)))
+                pending.add(tasks[1])
+
+            # The first response wins, failed attempt waits for the other one
+            failed = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        failed = failed or task
+                        continue
+                    call.take_response(calls[tasks.index(task)])
+                    if task is not tasks[0]:
+                        stats['won'] += 1
+                    return task.result()
+            if failed is not None:
+                return failed.result()
+            # The first attempt has finished before the hedge delay
+            call.take_response(calls[0])
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _attempt(self, call: '_Call', url, method, data, max_attempts, fail_fast, **cgi):
+        token = _current_call.set(call)
+        try:
+            return await self.request(self._make_session(), url, method, data, max_attempts, fail_fast=fail_fast, **cgi)
+        finally:
+            _current_call.reset(token)
+
+    def _hedge_delay(self) -> typing.Optional[float]:
+        if self.hedge_after is not None:
+            return self.hedge_after
+        samples = self._latency[self._host]
+        if len(samples) < self.hedge_min_samples:
+            return None
+        samples = sorted(samples)
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile / 100))]
 
     async def request(
             self,
@@ -119,30 +397,48 @@ class HttpClient(object):
             max_attempts=2,
             fail_fast=False,
             **cgi):
-        if fail_fast and self._next_req > datetime.now():
-            raise HttpTimeoutError(code=HTTPStatus.TOO_MANY_REQUESTS, message=f'Rate limit {self._base_url} exceeded')
-        await self._wait()
+        if fail_fast:
+            if not self.rate_limiter.try_acquire():
+                raise HttpTimeoutError(
+                    code=HTTPStatus.TOO_MANY_REQUESTS, message=f'Rate limit {self._base_url} exceeded')
+        else:
+            await self.rate_limiter.acquire()
         assert method in aiohttp.hdrs.METH_ALL
 
         async def retry(err):
             if not max_attempts or max_attempts < 2:
                 raise err
             proxy = f'through {self._proxy}' if self._proxy else ''
+            HttpMetrics().retry(self._base_url)
             logging.warning(f"Another attempt to {self._base_url} due to {err}. {proxy}")
             return await self.request(session, url, method, data, max_attempts - 1, **cgi)
 
+        call = _current_call.get()
+        started = time.monotonic()
         try:
             logging.debug(f"{method} to {url}")
-            async with session.request(
-                    method=method,
-                    proxy=self._proxy,
-                    url=url,
-                    data=json.dumps(data) if data else None,
-                    params=cgi,
-                    ssl_context=self._ssl_ctx
-            ) as response:
-                result = await self._read_body(response)
+            with HttpMetrics().measure(self._base_url) as trace:
+                async with session.request(
+                        method=method,
+                        proxy=self._proxy,
+                        url=url,
+                        data=json.dumps(data) if data else None,
+                        params=cgi,
+                        headers=self._headers | call.headers if call and call.headers else self._headers,
+                        timeout=self._timeout,
+                        ssl=self._ssl_ctx,
+                        trace_request_ctx=trace
+                ) as response:
+                    trace.status = response.status
+                    result = await self._read_body(response, trace)
+                    trace.size = response.content.total_bytes
+                if call:
+                    call.status, call.response_headers = response.status, response.headers
+                    call.size = response.content.total_bytes
+                    if response.status == HTTPStatus.NOT_MODIFIED and call.headers:
+                        return None
                 self.raise_for_status(response.status, response.reason, result)
+                self._latency[self._host].append(time.monotonic() - started)
                 return result
 
         # Specific exceptions
@@ -169,32 +465,188 @@ class HttpClient(object):
         except HttpException as e:
             return await retry(e)
 
-    async def _wait(self):
-        while self._next_req > datetime.now():
-            wait_for = self._next_req - datetime.now()
-            await asyncio.sleep(wait_for.seconds + wait_for.microseconds / 1000000)
-        self._next_req = datetime.now() + self._req_interval
+    async def stream(
+            self,
+            url: typing.AnyStr = None,
+            method=aiohttp.hdrs.METH_GET,
+            data: typing.Any = None,
+            chunk_size=None,
+            **cgi
+    ) -> typing.AsyncIterator[bytes]:
+        """
+        Yields body chunks as they arrive without buffering the body. There are no retries
+        """
+        async with self._open(url, method, data, **cgi) as response:
+            while chunk := await self._read_chunk(response, chunk_size or self.chunk_size):
+                yield chunk
+
+    async def stream_to(
+            self,
+            file_path,
+            url: typing.AnyStr = None,
+            method=aiohttp.hdrs.METH_GET,
+            data: typing.Any = None,
+            chunk_size=None,
+            **cgi
+    ) -> int:
+        """
+        Writes body to file_path, the file is replaced only when the whole body is received.
+        Returns number of bytes written
+        """
+        path = pathlib.Path(file_path)
+        tmp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+        size = 0
+        try:
+            with tmp_path.open('wb') as f:
+                async with contextlib.aclosing(self.stream(url, method, data, chunk_size, **cgi)) as chunks:
+                    async for chunk in chunks:
+                        f.write(chunk)
+                        size += len(chunk)
+            tmp_path.replace(path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return size
+
+    async def stream_xml(
+            self,
+            url: typing.AnyStr = None,
+            item_depth=2,
+            method=aiohttp.hdrs.METH_GET,
+            data: typing.Any = None,
+            chunk_size=None,
+            backlog=256,
+            **cgi
+    ) -> typing.AsyncIterator[typing.Tuple[typing.List, typing.Any]]:
+        """
+        Parses XML in a worker thread while it is downloaded and yields (path, item) for every element
+        at item_depth, see xmltodict item_depth. Neither the body nor the whole document are kept in memory
+        """
+        loop = asyncio.get_running_loop()
+        chunk_size = chunk_size or self.chunk_size
+        items = asyncio.Queue(maxsize=backlog)
+        bridge = _LoopBridge(loop)
+        end = object()
+
+        async with self._open(url, method, data, **cgi) as response:
+
+            def read_chunks():
+                while chunk := bridge.wait(self._read_chunk(response, chunk_size)):
+                    yield chunk
+
+            def on_item(path, item):
+                bridge.wait(items.put((path, item)))
+                return True
+
+            def parse():
+                try:
+                    xmltodict.parse(read_chunks(), item_depth=item_depth, item_callback=on_item)
+                finally:
+                    if not bridge.stopped.is_set():
+                        bridge.wait(items.put(end))
+
+            parsing = loop.run_in_executor(None, parse)
+            try:
+                while (item := await items.get()) is not end:
+                    yield item
+                await parsing
+            finally:
+                await bridge.stop(parsing)
+
+    @contextlib.asynccontextmanager
+    async def _open(self, url, method, data, **cgi) -> typing.AsyncIterator[aiohttp.ClientResponse]:
+        await self.rate_limiter.acquire()
+        logging.debug(f"{method} stream from {url}")
+        with HttpMetrics().measure(self._base_url) as trace:
+            with self._stream_errors():
+                response = await self._make_session().request(
+                    method=method,
+                    proxy=self._proxy,
+                    url=url,
+                    data=json.dumps(data) if data else None,
+                    params=cgi,
+                    headers=self._headers,
+                    timeout=self._timeout,
+                    ssl=self._ssl_ctx,
+                    trace_request_ctx=trace
+                )
+            trace.status = response.status
+            try:
+                if response.status != HTTPStatus.OK:
+                    self.raise_for_status(response.status, response.reason, await self._read_body(response))
+                yield response
+            finally:
+                trace.size = response.content.total_bytes
+                response.release()
+
+    async def _read_chunk(self, response: aiohttp.ClientResponse, chunk_size) -> bytes:
+        with self._stream_errors():
+            return await response.content.read(chunk_size)
+
+    @contextlib.contextmanager
+    def _stream_errors(self):
+        try:
+            yield
+        except asyncio.TimeoutError:
+            raise HttpTimeoutError(code=HTTPStatus.REQUEST_TIMEOUT, message=f"{self._base_url} timeout")
+        except aiohttp.ClientError as e:
+            raise HttpConnectionError(code=HTTPStatus.BAD_REQUEST, message=str(e))
 
     def _make_session(self) -> aiohttp.ClientSession:
-        return aiohttp.ClientSession(
-            base_url=self._base_url,
-            headers=self._headers,
-            timeout=self._timeout
-        )
+        return SessionPool().session(self._base_url, self._proxy)
 
-    async def _read_body(self, response: aiohttp.ClientResponse):
+    async def _read_body(self, response: aiohttp.ClientResponse, trace: RequestTrace = None):
         if response.content.at_eof() or response.content.exception() or \
                 (response.content.total_bytes == 0 and not response.connection):
             return None
 
+        stats = self.parse_stats[self._base_url]
+        call = _current_call.get()
+        if call and call.frame is not None and response.status == HTTPStatus.OK:
+            stats['frames'] += 1
+            return await self._read_frame(response, call.frame)
+
+        body = await response.read()
+        if len(body) > self.offload_parse_bytes:
+            stats['offloaded'] += 1
+            result, seconds = await as_async(_timed, self._parse_body, response, body)
+            stats['offloaded_seconds'] += seconds
+            if trace:
+                trace.parse = seconds
+            return result
+
+        result, loop_seconds = _timed(self._parse_body, response, body)
+        stats['inline'] += 1
+        stats['loop_seconds'] += loop_seconds
+        stats['loop_seconds_max'] = max(stats['loop_seconds_max'], loop_seconds)
+        if trace:
+            trace.parse = trace.loop_blocked = loop_seconds
+        if loop_seconds > self.slow_parse_seconds:
+            logging.warning(f"Parsing {len(body)} bytes of {response.url} blocked the loop for {loop_seconds:.3f}s")
+        return result
+
+    async def _read_frame(self, response: aiohttp.ClientResponse, options: typing.Dict):
+        loop = asyncio.get_running_loop()
+        bridge = _LoopBridge(loop)
+        body = io.BufferedReader(
+            _BodyReader(bridge, functools.partial(self._read_chunk, response)), buffer_size=self.chunk_size)
+        reading = loop.run_in_executor(None, _read_csv, body, {'encoding': response.charset or 'utf-8'} | options)
+        try:
+            # The worker uses the response, it has to stop before the response is released
+            return await asyncio.shield(reading)
+        finally:
+            await bridge.stop(reading)
+
+    def _parse_body(self, response: aiohttp.ClientResponse, body: bytes):
+        # Encoding detection and parsing are CPU bound, they run in a worker thread for large bodies
         json_content_type = response.content_type.startswith(CONTENT_TYPE_JSON)
         if json_content_type:
-            result = await response.json()
+            text = body.decode(response.get_encoding()).strip()
+            result = json_loads(text) if text else None
             if self._debug:
                 json.dumpf(result, 'response.json')
             return result
 
-        result = await response.text()
+        result = body.decode(response.get_encoding())
         if self._debug:
             pathlib.Path('response.txt').write_text(result)
 
@@ -0,0 +1,208 @@
+import contextlib
+import time
+import typing
+from collections import defaultdict
+from types import SimpleNamespace
+
+import aiohttp
+
+from ..pattern import Singleton
+from ..primitives.histogram import Histogram
+
+__all__ = ['HttpMetrics', 'RequestTrace']
+
+# parse is the body decoding time, loop_blocked is the part of it spent on the event loop
+_PHASES = ('dns', 'connect', 'ttfb', 'body', 'total', 'parse', 'loop_blocked')
+
+
+class RequestTrace(object):
+    '''
+    Timings of one request, trace hooks fill it in and HttpMetrics.finish() records it
+    '''
+    __slots__ = (
+        'base_url', 'started', 'dns', 'connect', 'headers_at', 'reused', 'status', 'size', 'error', 'parse',
+        'loop_blocked'
+    )
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.started = time.monotonic()
+        self.dns = None
+        self.connect = None
+        self.headers_at = None
+        self.reused = False
+        self.status = None
+        self.size = 0
+        self.error = None
+        self.parse = None
+        self.loop_blocked = None
+
+
+class _HostMetrics(object):
+
+    def __init__(self):
+        self.latency = {phase: Histogram() for phase in _PHASES}
+        self.size = Histogram(resolution=1)
+        self.statuses: typing.Dict[int, int] = defaultdict(int)
+        self.errors: typing.Dict[str, int] = defaultdict(int)
+        self.requests = 0
+        self.retries = 0
+        self.reused = 0
+        self.bytes = 0
+
+    def as_dict(self) -> typing.Dict:
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'reused_connections': self.reused,
+            'bytes': self.bytes,
+            'statuses': dict(self.statuses),
+            'errors': dict(self.errors),
+            'latency': {phase: h.summary() for phase, h in self.latency.items() if h.count},
+            'size': self.size.summary(),
+        }
+
+
+class HttpMetrics(metaclass=Singleton):
+    '''
+    Process wide HttpClient metrics per base url
+    1. DNS, connect, time to first byte, body and total time histograms
+    2. Response sizes, status codes, errors and retries
+    3. Body parse time and event loop blocking time of every parsed response
+    Hooks are attached to SessionPool sessions through trace_config, clients pass RequestTrace as trace_request_ctx
+    '''
+
+    def __init__(self):
+        self._hosts: typing.Dict[str, _HostMetrics] = defaultdict(_HostMetrics)
+        self.trace_config = aiohttp.TraceConfig(trace_config_ctx_factory=SimpleNamespace)
+        self.trace_config.on_dns_resolvehost_start.append(_on_dns_start)
+        self.trace_config.on_dns_resolvehost_end.append(_on_dns_end)
+        self.trace_config.on_connection_create_start.append(_on_connect_start)
+        self.trace_config.on_connection_create_end.append(_on_connect_end)
+        self.trace_config.on_connection_reuseconn.append(_on_reuse)
+        self.trace_config.on_request_end.append(_on_headers)
+        self.trace_config.on_request_exception.append(_on_exception)
+
+    @contextlib.contextmanager
+    def measure(self, base_url) -> typing.Iterator[RequestTrace]:
+        """
+        Caller sets status and size of the trace, exception without a response is counted as error
+        """
+        trace = RequestTrace(base_url)
+        try:
+            yield trace
+        except BaseException as e:
+            if trace.status is None and trace.error is None:
+                trace.error = type(e).__name__
+            raise
+        finally:
+            self.finish(trace)
+
+    def finish(self, trace: RequestTrace):
+        now = time.monotonic()
+        host = self._hosts[trace.base_url]
+        host.requests += 1
+        host.reused += trace.reused
+        if trace.status is not None:
+            host.statuses[trace.status] += 1
+        if trace.error:
+            host.errors[trace.error] += 1
+        if trace.dns is not None:
+            host.latency['dns'].record(trace.dns)
+        if trace.connect is not None:
+            host.latency['connect'].record(trace.connect)
+        if trace.headers_at is not None:
+            host.latency['ttfb'].record(trace.headers_at - trace.started)
+            host.latency['body'].record(now - trace.headers_at)
+        host.latency['total'].record(now - trace.started)
+        if trace.parse is not None:
+            host.latency['parse'].record(trace.parse)
+        if trace.loop_blocked is not None:
+            host.latency['loop_blocked'].record(trace.loop_blocked)
+        if trace.size:
+            host.bytes += trace.size
+            host.size.record(trace.size)
+
+    def retry(self, base_url):
+        self._hosts[base_url].retries += 1
+
+    def snapshot(self) -> typing.Dict[str, typing.Dict]:
+        return {base_url: host.as_dict() for base_url, host in self._hosts.items()}
+
+    def prometheus(self) -> str:
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{{{",".join(f"{k}={_quote(v)}" for k, v in labels.items())}}} {value}')
+
+        hosts = list(self._hosts.items())
+        metric('http_client_requests_total', 'counter', 'Responses by status', [
+            ({'base_url': b, 'status': s}, c) for b, h in hosts for s, c in h.statuses.items()])
+        metric('http_client_errors_total', 'counter', 'Failed requests by error', [
+            ({'base_url': b, 'error': e}, c) for b, h in hosts for e, c in h.errors.items()])
+        metric('http_client_retries_total', 'counter', 'Retried requests', [
+            ({'base_url': b}, h.retries) for b, h in hosts])
+        metric('http_client_response_bytes_total', 'counter', 'Received body bytes', [
+            ({'base_url': b}, h.bytes) for b, h in hosts])
+
+        samples = []
+        for b, h in hosts:
+            for phase, histogram in h.latency.items():
+                if not histogram.count:
+                    continue
+                for q in (0.5, 0.9, 0.99):
+                    samples.append(({'base_url': b, 'phase': phase, 'quantile': q}, histogram.percentile(q * 100)))
+        metric('http_client_seconds', 'summary', 'Request phase latency', samples)
+        for suffix, attr in (('sum', 'total'), ('count', 'count')):
+            lines.extend(
+                f'http_client_seconds_{suffix}{{base_url={_quote(b)},phase={_quote(phase)}}} {getattr(histogram, attr)}'
+                for b, h in hosts for phase, histogram in h.latency.items() if histogram.count)
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        self._hosts.clear()
+
+
+def _quote(value) -> str:
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+def _trace(context) -> typing.Optional[RequestTrace]:
+    trace = context.trace_request_ctx
+    return trace if isinstance(trace, RequestTrace) else None
+
+
+async def _on_dns_start(session, context, params):
+    context.dns_started = time.monotonic()
+
+
+async def _on_dns_end(session, context, params):
+    if trace := _trace(context):
+        trace.dns = time.monotonic() - context.dns_started
+
+
+async def _on_connect_start(session, context, params):
+    context.connect_started = time.monotonic()
+
+
+async def _on_connect_end(session, context, params):
+    if trace := _trace(context):
+        trace.connect = time.monotonic() - context.connect_started
+
+
+async def _on_reuse(session, context, params):
+    if trace := _trace(context):
+        trace.reused = True
+
+
+async def _on_headers(session, context, params):
+    if trace := _trace(context):
+        trace.headers_at = time.monotonic()
+
+
+async def _on_exception(session, context, params):
+    if trace := _trace(context):
+        trace.error = type(params.exception).__name__
@@ -0,0 +1,17 @@
+from .metrics import HttpMetrics
+from .request_handler import RequestHandler
+
+__all__ = ['HttpMetricsHandler']
+
+
+class HttpMetricsHandler(RequestHandler):
+    '''
+    HttpClient metrics, JSON by default and Prometheus text with ?format=prometheus
+    '''
+
+    def get(self):
+        if self.get_argument('format', 'json') == 'prometheus':
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=UTF-8")
+            self.write(HttpMetrics().prometheus())
+            return
+        self.write(HttpMetrics().snapshot())
@@ -1,20 +1,24 @@
 import asyncio
 import base64
+import binascii
+import inspect
 import logging
+import math
 import sys
+import time
 import typing
 
 from abc import ABC, abstractmethod
 from builtins import AttributeError
 from collections import defaultdict
-from copy import deepcopy
 from distutils.util import strtobool
-from functools import partial, cached_property
+from functools import cached_property, partial
 from http import HTTPStatus
 
 from dateutil.parser import parse
-from google.api_core.exceptions import Aborted, RetryError, DeadlineExceeded
+from google.api_core.exceptions import Aborted, AlreadyExists, RetryError, DeadlineExceeded
 from google.cloud import firestore, pubsub
+from google.cloud.firestore_v1.field_path import FieldPath
 from google.cloud.exceptions import ServiceUnavailable, GatewayTimeout, InternalServerError
 from marshmallow import ValidationError, Schema, fields, EXCLUDE
 from tornado.web import HTTPError
@@ -24,11 +28,13 @@ from .exceptions import (
     HttpConnectionError, HttpBadRequestError, HttpServerError
 )
 
+from .batch_writer import FirestoreBatchWriter
 from .request_handler import RequestHandler
 from ..primitives import name
-from ..concurrent import as_async
+from ..concurrent import as_task, gather_or_cancel, RateLimiter
 from ..defs import START_OF_EPOCH
 from ..primitives import json, datetime
+from ..primitives.lru import LruCache
 
 
 __all__ = ['QueueUpdateHandler']
@@ -52,6 +58,97 @@ class PubSubBodySchema(Schema):
     subscription = fields.String(required=True)
 
 
+class _Argument(object):
+    """
+    Argument of QueueUpdateHandler compiled from its default value: the type is inferred once,
+    a callable default is a factory called for every request.
+    """
+    __slots__ = ('key', 'type', '_value', '_factory', '_cast_fn')
+
+    def __init__(self, key, default, cast_functions: typing.Dict[type, typing.Callable]):
+        self.key = key
+        self._factory = default if callable(default) and not isinstance(default, type) else None
+        self._value = None if self._factory else default
+        value = self.default()
+        self.type = type(value) if value is not None else None
+        self._cast_fn = None
+        if self.type is not None:
+            assert self.type in cast_functions, f"Unknown type {self.type} of argument {key}"
+            self._cast_fn = cast_functions[self.type]
+
+    def default(self):
+        return self._factory() if self._factory else self._value
+
+    def cast(self, value):
+        if value is None:
+            return None
+        if self.type is None:
+            assert isinstance(value, str), f"Unknown type {type(value)} of argument {self.key}"
+            return value
+        if isinstance(value, self.type):
+            return value
+        return self._cast_fn(value)
+
+    def to_str(self, value) -> str:
+        """
+        String representation to publish the value. It has to be cast back to the same value
+        """
+        text = str(value)
+        assert self.cast(text) == value, f"Can't cast {value} of {self.key}"
+        return text
+
+
+class _Sweep(object):
+    """
+    Progress of a sweep over items() that can be resumed after the last item it gave away.
+    rewind() drops the progress when given items may be lost, e.g. their messages failed to publish.
+    The cursor of a stale sweep has the freshness field as well, so it can only be resumed by a stale sweep
+    """
+
+    def __init__(self, cursor: typing.Dict = None, total=0, stale=False):
+        self.cursor = cursor
+        self.total = total
+        self.stale = stale
+        self.processed = 0
+        self.done = False
+        self._start = cursor
+
+    @classmethod
+    def from_token(cls, token: typing.Optional[str]) -> typing.Optional['_Sweep']:
+        if not token:
+            return None
+        try:
+            state = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        except (binascii.Error, UnicodeError, json.JSONDecodeError) as e:
+            raise ValueError(f"Invalid resume token: {e}")
+        return cls(state.get('cursor'), state.get('total', 0), bool(state.get('stale')))
+
+    def token(self) -> str:
+        state = {'cursor': self.cursor, 'total': self.total + self.processed, 'stale': self.stale}
+        return base64.urlsafe_b64encode(json.dumps(state).encode('utf-8')).decode('ascii')
+
+    def rewind(self):
+        self.cursor, self.processed, self.done = self._start, 0, False
+
+    def progress(self) -> typing.Dict:
+        return {'processed': self.processed, 'total': self.total + self.processed, 'done': self.done}
+
+    async def track(self, items, cursor_fn: typing.Callable[[typing.Dict], typing.Dict], limit=None, budget=None):
+        deadline = time.monotonic() + budget if budget else None
+        items = _iterate(items)
+        try:
+            async for item_id, item in items:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                yield item_id, item
+                # The consumer has taken the item, so the sweep continues after it
+                self.processed += 1
+                self.cursor = cursor_fn(item)
+            self.done = not limit or self.processed < int(limit)
+        finally:
+            await items.aclose()
+
+
 class QueueUpdateHandler(RequestHandler, ABC):
     # Required properties
     what = None
@@ -63,10 +160,11 @@ class QueueUpdateHandler(RequestHandler, ABC):
     fields = None
     arguments = {}
 
+    # Callable default is called for every request, so 'now' is the time of the request
     _default_arguments = {
         'obsolescence': 12,
         'item_id': None,
-        'now': datetime.now()
+        'now': datetime.now
     }
 
     _arguments_cast_functions = {
@@ -78,9 +176,56 @@ class QueueUpdateHandler(RequestHandler, ABC):
     }
 
     default_obsolescence_hours = 12
+    page_size = 16384
+    update_concurrency = 1  # Items updated in parallel for sync=1, CGI concurrency overrides it
+    max_update_concurrency = 64  # CGI concurrency is clamped to it
+
+    # Publishing: messages per second (CGI rate or interval override it), burst and not yet confirmed messages.
+    # Response status is 503 when any message failed to publish, so that the scheduler retries the call
+    publish_rate = 500.0
+    publish_burst = 100
+    publish_in_flight = 1000
+    publish_batch_settings = pubsub.types.BatchSettings(max_messages=500, max_bytes=1024 * 1024, max_latency=0.05)
+
+    # updated.<topic_id> markers are committed in batches of this size or after this many seconds
+    freshness_batch_size = 500
+    freshness_flush_interval = 1.0
+
+    # Select only obsolete documents in firestore, CGI stale overrides it. See stale_query
+    staleness_query = False
+
+    # Sweeps stop after sweep_budget seconds (CGI budget) and may be continued with the returned resume token.
+    # With checkpoint_sweeps (CGI checkpoint) the token is kept in checkpoint_collection between calls
+    sweep_budget = None
+    checkpoint_sweeps = False
+    checkpoint_collection = 'queue_update_checkpoints'
+
+    # Redelivered messageId is acknowledged without update for dedup_ttl seconds (0 disables it),
+    # while the first delivery is still in progress the redelivery is answered 409.
+    # dedup_collection shares message ids between instances, set Firestore TTL policy on its expire_at field.
+    # Message that is in progress longer than dedup_lease seconds is considered abandoned
+    dedup_ttl = 60 * 60
+    dedup_size = 65536
+    dedup_collection = None
+    dedup_lease = 10 * 60
+
+    # Publish one message per range of order_by keys instead of one per item (CGI shards or range_size).
+    # Receiver sweeps its range within one push request, so size ranges to fit the ack deadline.
+    # is_actual filters fresh items inside the range, staleness query is not applied
+    fanout_shards = 0
+    fanout_range_size = 0
 
     body_schema = PubSubBodySchema()
 
+    _argument_spec: typing.Dict[str, '_Argument'] = {}
+    _message_ids: LruCache = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        merged = (cls.arguments or {}) | cls._default_arguments
+        cls._argument_spec = {key: _Argument(key, d, cls._arguments_cast_functions) for key, d in merged.items()}
+        cls._message_ids = LruCache(cls.dedup_size, cls.dedup_ttl)
+
     @abstractmethod
     async def update_one(self, item_id, item: typing.Dict, **kwargs) -> typing.Dict:
         raise NotImplementedError()
@@ -95,6 +240,13 @@ class QueueUpdateHandler(RequestHandler, ABC):
     def db(self) -> firestore.AsyncClient:
         raise NotImplementedError()
 
+    @classmethod
+    def make_publisher(cls, **kwargs) -> pubsub.PublisherClient:
+        """
+        Publisher client configured with publish_batch_settings. Create it once and return from publisher property
+        """
+        return pubsub.PublisherClient(batch_settings=cls.publish_batch_settings, **kwargs)
+
     def get_log_msg(self, item_id, message):
         return f'{self.what} [id={item_id}]: {message}'
 
@@ -106,31 +258,75 @@ class QueueUpdateHandler(RequestHandler, ABC):
     def query(self) -> firestore.AsyncQuery:
         return self.collection.order_by(self.order_by).select(self.get_fields())
 
-    async def items(self, limit=None, skip=None) -> typing.Iterable[typing.Tuple[str, dict]]:
+    @property
+    def freshness_field(self) -> str:
+        return FieldPath('updated', self.topic_id).to_api_repr()
+
+    def stale_query(self, obsolescence) -> firestore.AsyncQuery:
+        """
+        Only documents updated before update_from(obsolescence), the most obsolete first.
+        Documents without updated.<topic_id> are not returned, run GET with backfill=1 to mark them.
+        Requires the composite index from staleness_index()
+        """
+        stale = firestore.FieldFilter(self.freshness_field, '<', self.update_from(obsolescence))
+        query = self.collection.where(filter=stale).order_by(self.freshness_field).order_by(self.order_by)
+        return query.select(self.get_fields())
+
+    @classmethod
+    def staleness_index(cls) -> typing.Dict:
+        """
+        Composite index definition for stale_query in firestore.indexes.json format
+        """
+        return {
+            "collectionGroup": cls.collection_name,
+            "queryScope": "COLLECTION",
+            "fields": [
+                {"fieldPath": FieldPath('updated', cls.topic_id).to_api_repr(), "order": "ASCENDING"},
+                {"fieldPath": cls.order_by, "order": "ASCENDING"},
+            ]
+        }
+
+    def items(
+            self, limit=None, skip=None, query=None, start_after=None
+    ) -> typing.AsyncIterator[typing.Tuple[str, dict]]:
+        """
+        Arguments are checked and the query is built right away, so a bad request is answered 400
+        before anything is published or updated
+        """
         limit = int(limit) if limit else sys.maxsize
         skip = int(skip) if skip else 0
         if skip > 1024:
             raise HTTPError(HTTPStatus.BAD_REQUEST, "Skip must be in [0, 1024]")
-
-        batch_size = 16384
-        result = []
-        query = self.query().limit(min(limit, batch_size)).offset(skip)
-
-        # Fetch batch_size until limit is reached, otherwise we face the timeout from firestore
-        while limit > 0:
-            added, doc = 0, {}
-            async for doc in query.stream():
-                result.append((doc.id, doc.to_dict()))
-                added += 1
-                limit -= 1
-
-            if added < batch_size:
-                break
-
-            # order by id helps navigate offset, otherwise timeout.
-            query = self.query().limit(min(limit, batch_size)).start_after(doc)
-
-        return result
+        query = query or self.query()
+        first_query = query.start_after(start_after) if start_after else query
+        return self._items(query, first_query.limit(min(limit, self.page_size)).offset(skip), limit)
+
+    async def _items(self, query, first_query, limit) -> typing.AsyncIterator[typing.Tuple[str, dict]]:
+        # Fetch page_size until limit is reached, otherwise we face the timeout from firestore.
+        # The next page is prefetched while the current one is consumed, so at most two pages are kept in memory.
+        page = as_task(self._read_page(first_query))
+        try:
+            try:
+                docs = await page
+            except ValueError as e:
+                # Firestore checks cursor values only when the query is sent
+                raise HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+            while docs is not None:
+                page = None
+                limit -= len(docs)
+                if len(docs) >= self.page_size and limit > 0:
+                    # order by id helps navigate offset, otherwise timeout.
+                    next_query = query.limit(min(limit, self.page_size)).start_after(docs[-1])
+                    page = as_task(self._read_page(next_query))
+                for doc in docs:
+                    yield doc.id, doc.to_dict()
+                docs = await page if page is not None else None
+        finally:
+            if page is not None:
+                page.cancel()
+
+    async def _read_page(self, query: firestore.AsyncQuery) -> typing.List[firestore.DocumentSnapshot]:
+        return [doc async for doc in query.stream()]
 
     async def item(self, item_id) -> dict:
         return (await self.collection.document(item_id).get(self.get_fields())).to_dict()
@@ -140,6 +336,20 @@ class QueueUpdateHandler(RequestHandler, ABC):
         assert self.collection_name, "Define collection_name in the class to call this method"
         return self.db.collection(self.collection_name)
 
+    @cached_property
+    def freshness_writer(self) -> FirestoreBatchWriter:
+        return FirestoreBatchWriter(
+            self.db, self.freshness_batch_size, self.freshness_flush_interval, prefix='freshness_')
+
+    async def mark_updated(self, item_id):
+        await self.freshness_writer.set(self.collection.document(item_id), {'updated': {self.topic_id: self.now()}})
+
+    async def flush_updated(self, collected_metrics):
+        if 'freshness_writer' not in self.__dict__:
+            return
+        await self.freshness_writer.flush()
+        collected_metrics.update(self.freshness_writer.metrics)
+
     def update_from(self, obsolescence):
         return self.now() - datetime.timedelta(hours=int(obsolescence))
 
@@ -156,9 +366,20 @@ class QueueUpdateHandler(RequestHandler, ABC):
     async def get(self):
         try:
             sync = strtobool(self.get_query_argument('sync', '0'))
+            stale = strtobool(self.get_query_argument('stale', str(int(self.staleness_query))))
+            backfill = strtobool(self.get_query_argument('backfill', '0'))
             limit = int(self.get_query_argument('limit', '0'))
             skip = int(self.get_query_argument('skip', '0'))
-            interval = float(self.get_query_argument('interval', 0.05))
+            interval = float(self.get_query_argument('interval', 0))
+            rate = float(self.get_query_argument('rate', 1 / interval if interval else self.publish_rate))
+            concurrency = int(self.get_query_argument('concurrency', self.update_concurrency))
+            checkpoint = strtobool(self.get_query_argument('checkpoint', str(int(self.checkpoint_sweeps))))
+            budget = float(self.get_query_argument('budget', self.sweep_budget or 0))
+            shards = int(self.get_query_argument('shards', self.fanout_shards))
+            range_size = int(self.get_query_argument('range_size', self.fanout_range_size))
+            sweep = _Sweep.from_token(self.get_query_argument('resume', None))
+            if sweep is not None and sweep.stale != stale:
+                raise ValueError(f"Resume token belongs to a sweep with stale={int(sweep.stale)}")
         except ValueError as e:
             raise HTTPError(HTTPStatus.BAD_REQUEST, str(e))
 
@@ -170,21 +391,47 @@ class QueueUpdateHandler(RequestHandler, ABC):
             item = await self.item(item_id)
             args['item_id'] = item_id
             await self._do_update_one(collected_metrics, item=item, **args)
-            self.write(collected_metrics if collected_metrics else {'updated': 1})
+            if not collected_metrics:
+                collected_metrics['updated'] = 1
+            await self.flush_updated(collected_metrics)
+            self.write(collected_metrics)
             return
 
-        try:
-            items_to_update = await self.items(limit, skip)
-        except ValueError as e:
-            raise HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+        if backfill:
+            self.write(await self._do_backfill(self.items(limit, skip)))
+            return
 
-        if sync:
-            collected_metrics = await self._do_update_all(items_to_update, **args)
-            self.write(collected_metrics)
+        if not sync and (shards or range_size):
+            self._write_published(await self._do_publish_ranges(shards, range_size, rate=rate, **args))
             return
 
-        await self._do_publish_all(items_to_update, interval=float(interval), **args)
-        self.write({"published": len(items_to_update)})
+        query = self.stale_query(args['obsolescence']) if stale else None
+        if checkpoint and sweep is None:
+            sweep = await self._load_checkpoint(stale)
+        if sweep is None and (checkpoint or budget):
+            sweep = _Sweep(stale=stale)
+
+        items_to_update = self.items(limit, skip, query=query, start_after=sweep.cursor if sweep else None)
+        if sweep is not None:
+            items_to_update = sweep.track(items_to_update, partial(self._cursor, stale=stale), limit, budget)
+
+        if sync:
+            result = await self._do_update_all(items_to_update, concurrency=concurrency, **args)
+        else:
+            result = await self._do_publish_all(items_to_update, rate=rate, **args)
+
+        if sweep is not None:
+            if not sync and result.get('failed'):
+                # Failed messages are somewhere behind the cursor, the next call repeats this part of the sweep
+                sweep.rewind()
+            if checkpoint:
+                await self._save_checkpoint(sweep)
+            result['progress'] = sweep.progress()
+            result['resume'] = None if sweep.done else sweep.token()
+        if sync:
+            self.write(result)
+        else:
+            self._write_published(result)
 
     async def post(self):
         """
@@ -205,89 +452,311 @@ class QueueUpdateHandler(RequestHandler, ABC):
 
         """
         message = self.json_body.get('message')
-        try:
-            attributes = self._post_arguments(**(message.get('attributes') or {}))
-        except ValueError as e:
-            logging.error(f"{self.what} attrs={message.get('attributes')} error={e}")
-            raise HTTPError(HTTPStatus.BAD_REQUEST, str(e))
-
-        collected_metrics = defaultdict(int)
         data = message.get('data')
-        item_id = attributes.get('item_id', None)
-        item = None
-        if data:
-            data = base64.b64decode(message.get('data'))
-            logging.debug(f'{self.what} attrs={attributes} data={data}')
-            item = json.loads(data) if data else None
-        if item_id and item is None:
-            item = await self.item(item_id)
-        await self._do_update_one(collected_metrics, item=item, **attributes)
+        collected_metrics = await self.process_message(
+            message.get('attributes') or {},
+            base64.b64decode(data) if data else None,
+            message.get('messageId')
+        )
         self.write(collected_metrics)
 
+    async def process_message(self, attributes: typing.Dict, data: typing.Optional[bytes] = None, message_id=None):
+        """
+        Updates the item from pub/sub message attributes and decoded data.
+        Shared by push delivery (post) and pull delivery (QueueUpdateSubscriber).
+        Redelivery of the processed message_id is counted as duplicate and skipped.
+        Redelivery of the message_id that is being processed is answered 409, so it comes back later
+        """
+        collected_metrics = defaultdict(int)
+        if message_id and not await self._claim_message(message_id):
+            logging.info(f"{self.what} message {message_id} is duplicate")
+            collected_metrics['duplicate'] += 1
+            return collected_metrics
+
+        try:
+            attributes = dict(attributes)
+            shard = attributes.pop('shard', None)
+            try:
+                attributes = self._post_arguments(**attributes)
+            except ValueError as e:
+                logging.error(f"{self.what} attrs={attributes} error={e}")
+                raise HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+
+            if shard:
+                collected_metrics.update(await self._do_update_range(json.loads(shard), **attributes))
+            else:
+                item_id = attributes.get('item_id', None)
+                item = None
+                if data:
+                    logging.debug(f'{self.what} attrs={attributes} data={data}')
+                    item = json.loads(data)
+                if item_id and item is None:
+                    item = await self.item(item_id)
+                await self._do_update_one(collected_metrics, item=item, **attributes)
+            await self._complete_message(message_id)
+            await self.flush_updated(collected_metrics)
+        except BaseException:
+            # Message is going to be redelivered, so it must not look like a duplicate
+            await self._release_message(message_id)
+            raise
+        return collected_metrics
+
+    def _dedup_document(self, message_id) -> firestore.AsyncDocumentReference:
+        return self.db.collection(self.dedup_collection).document(message_id)
+
+    async def _claim_message(self, message_id) -> bool:
+        """
+        False for the processed message. The one in progress may still fail, so it must not be acked
+        """
+        if not self.dedup_ttl:
+            return True
+        if message_id in self._message_ids:
+            if self._message_ids.get(message_id):
+                return False
+            raise HTTPError(HTTPStatus.CONFLICT, f"Message {message_id} is in progress")
+        self._message_ids.set(message_id, False)
+        if not self.dedup_collection:
+            return True
+
+        now = datetime.now()
+        claim = {'done': False, 'started': now, 'expire_at': now + datetime.timedelta(seconds=self.dedup_ttl)}
+        try:
+            await self._dedup_document(message_id).create(claim)
+            return True
+        except AlreadyExists:
+            pass
+
+        # Another instance has got the message. Take it over only if that one is likely dead
+        existing = (await self._dedup_document(message_id).get()).to_dict() or {}
+        started = existing.get('started') or START_OF_EPOCH
+        if existing.get('done'):
+            self._message_ids.set(message_id, True)
+            return False
+        if started > now - datetime.timedelta(seconds=self.dedup_lease):
+            self._message_ids.pop(message_id)
+            raise HTTPError(HTTPStatus.CONFLICT, f"Message {message_id} is in progress on another instance")
+        await self._dedup_document(message_id).set(claim)
+        return True
+
+    async def _complete_message(self, message_id):
+        if not message_id or not self.dedup_ttl:
+            return
+        self._message_ids.set(message_id, True)
+        if self.dedup_collection:
+            # Committed together with the updated marker, no extra round trip
+            await self.freshness_writer.set(self._dedup_document(message_id), {'done': True})
+
+    async def _release_message(self, message_id):
+        if not message_id or not self.dedup_ttl:
+            return
+        self._message_ids.pop(message_id)
+        if self.dedup_collection:
+            try:
+                await self._dedup_document(message_id).delete()
+            except Exception as e:
+                logging.warning(f"{self.what} failed to release message {message_id}: {e}")
+
     @cached_property
     def project_id(self):
         return self.db.project
 
     def _cgi_arguments(self):
-        args = self._all_arguments()
-        for k, d in args.items():
-            args[k] = self._cast_argument_value(k, self.get_query_argument(k, d))
+        args = {}
+        for key, argument in self._argument_spec.items():
+            value = self.get_query_argument(key, None)
+            args[key] = argument.default() if value is None else argument.cast(value)
         return args
 
     def _post_arguments(self, **kwargs):
         args = self._all_arguments()
-        for k, d in kwargs.items():
-            args[k] = self._cast_argument_value(k, d)
+        for k, v in kwargs.items():
+            args[k] = self._argument(k).cast(v)
         return args
 
     def _all_arguments(self):
-        return deepcopy((self.arguments or {}) | self._default_arguments)
+        return {key: argument.default() for key, argument in self._argument_spec.items()}
 
-    def _cast_argument_value(self, key, value):
-        args = self._all_arguments()
-        if key not in args:
+    def _argument(self, key) -> '_Argument':
+        argument = self._argument_spec.get(key)
+        if argument is None:
             raise HTTPError(422, f"Unknown argument {key}")
+        return argument
 
-        if args[key] is None and isinstance(value, str):
-            return value
+    def _cast_argument_value(self, key, value):
+        return self._argument(key).cast(value)
 
-        if value is None:
-            return None
+    def _can_cast_argument_value(self, key, value):
+        if value is not None:
+            self._argument(key).to_str(value)
+        return True
 
-        expected_type = type(args[key])
+    def _write_published(self, result):
+        # Unpublished items are not retried by anyone else, non-2xx makes the scheduler repeat the call
+        if result.get('failed'):
+            self.set_status(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.write(result)
 
-        if isinstance(value, expected_type):
-            return value
+    async def _do_publish_all(self, items_to_update, rate=None, **kwargs):
+        attributes = self._publish_attributes(**kwargs)
 
-        assert expected_type in self._arguments_cast_functions, f"Unknown type {expected_type}"
-        return self._arguments_cast_functions[expected_type](value)
+        async def messages():
+            async for item_id, item in _iterate(items_to_update):
+                yield json.dumps(item).encode('utf-8'), attributes | {'item_id': item_id}
 
-    def _can_cast_argument_value(self, key, value):
-        if value is None:
-            return True
+        return await self._publish(messages(), rate)
+
+    async def _do_publish_ranges(self, shards=0, range_size=0, rate=None, **kwargs):
+        """
+        Splits order_by key space into ranges of range_size documents (or into shards ranges)
+        and publishes one message per range. Receiver sweeps its range with _do_update_range
+        """
+        attributes = self._publish_attributes(**kwargs)
+        query = self.query()
+        if not range_size:
+            count = (await query.count().get())[0][0].value
+            range_size = max(math.ceil(count / max(int(shards), 1)), 1)
+
+        def shard_message(start, end):
+            return b'', attributes | {'shard': json.dumps({'start': start, 'end': end})}
+
+        async def messages():
+            # Only keys are read to find boundaries, documents are read by receivers.
+            # Equal keys never cross a boundary, so a range may be larger than range_size but is never empty
+            start, previous, in_range = None, None, 0
+            async for _, key in self.items(query=query.select([self.order_by])):
+                value = key.get(self.order_by)
+                if in_range >= range_size and value != previous:
+                    yield shard_message(start, value)
+                    start, in_range = value, 0
+                previous = value
+                in_range += 1
+            if in_range:
+                yield shard_message(start, None)
+
+        result = await self._publish(messages(), rate)
+        result['range_size'] = range_size
+        return result
 
-        assert self._cast_argument_value(key, str(value)) == value, f"Can't cast {value} of {key}"
+    async def _do_update_range(self, shard: typing.Dict, **kwargs):
+        query = self.query()
+        if shard.get('start') is not None:
+            query = query.where(filter=firestore.FieldFilter(self.order_by, '>=', shard['start']))
+        if shard.get('end') is not None:
+            query = query.where(filter=firestore.FieldFilter(self.order_by, '<', shard['end']))
+        return await self._do_update_all(self.items(query=query), concurrency=self.update_concurrency, **kwargs)
 
-    async def _do_publish_all(self, items_to_update, interval=0.001, **kwargs):
-        def _check_value(key, value):
-            self._can_cast_argument_value(key, value)
-            return str(value)
+    def _publish_attributes(self, **kwargs) -> typing.Dict[str, str]:
+        return {k: self._argument(k).to_str(v) for k, v in kwargs.items() if v is not None}
 
+    async def _publish(self, messages: typing.AsyncIterator[typing.Tuple[bytes, typing.Dict]], rate=None):
         topic_path = self.publisher.topic_path(self.project_id, self.topic_id)
-        kwargs = {k: _check_value(k, v) for k, v in kwargs.items() if v is not None}
+        limiter = RateLimiter(rate or self.publish_rate, burst=self.publish_burst)
+        stats = defaultdict(int)
+        in_flight = set()
+        started = time.monotonic()
+
+        def collect(done_futures):
+            for f in done_futures:
+                if f.exception() is None:
+                    stats['published'] += 1
+                    continue
+                stats['failed'] += 1
+                logging.warning(f"{self.what} failed to publish to {self.topic_id}: {f.exception()}")
+
+        # Publisher client batches messages by itself, so keep many futures in flight instead of waiting each of them
+        async for data, attributes in messages:
+            await limiter.acquire()
+            if len(in_flight) >= self.publish_in_flight:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(asyncio.wrap_future(self.publisher.publish(topic_path, data, **attributes)))
+
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            collect(done)
+
+        seconds = time.monotonic() - started
+        return {
+            'published': stats['published'],
+            'failed': stats['failed'],
+            'seconds': round(seconds, 3),
+            'rate': round(stats['published'] / seconds, 1) if seconds > 0 else 0.0,
+        }
 
-        for item_id, item in items_to_update:
-            kwargs['item_id'] = item_id
-            data = json.dumps(item).encode('utf-8')
-            f = await as_async(partial(self.publisher.publish, topic_path, data, **kwargs))
-            await asyncio.sleep(interval)
-            await as_async(f.result)
+    async def _do_update_all(self, items_to_update, concurrency=1, **kwargs):
+        collected_metrics = defaultdict(int)
+        concurrency = min(max(int(concurrency or 1), 1), self.max_update_concurrency)
+        backlog = asyncio.Queue(maxsize=2 * concurrency)
+
+        async def produce():
+            async for item_id, item in _iterate(items_to_update):
+                await backlog.put((item_id, item))
+            for _ in range(concurrency):
+                await backlog.put(None)
+
+        async def work():
+            # Every worker collects its own metrics, they are merged once the worker is done or failed
+            metrics = defaultdict(int)
+            try:
+                while (entry := await backlog.get()) is not None:
+                    item_id, item = entry
+                    await self._do_update_one(metrics, item=item, **(kwargs | {'item_id': item_id}))
+            finally:
+                for k, v in metrics.items():
+                    collected_metrics[k] += v
+
+        try:
+            await gather_or_cancel([produce()] + [work() for _ in range(concurrency)])
+        except BaseException:
+            # Keep the markers of items that are already updated, but report the original error
+            try:
+                await self.flush_updated(collected_metrics)
+            except Exception as e:
+                logging.warning(f"{self.what} failed to flush updated markers: {e}")
+            raise
+        await self.flush_updated(collected_metrics)
+        return collected_metrics
 
-    async def _do_update_all(self, items_to_update, **kwargs):
+    def _cursor(self, item: typing.Dict, stale=False) -> typing.Dict:
+        """
+        Values of the fields the sweep is ordered by, suitable for query.start_after
+        """
+        cursor = {self.order_by: item.get(self.order_by)}
+        if stale:
+            cursor['updated'] = {self.topic_id: (item.get('updated') or {}).get(self.topic_id)}
+        return cursor
+
+    def checkpoint_document(self, stale=False) -> firestore.AsyncDocumentReference:
+        """
+        Stale and full sweeps go in a different order, so each of them has its own checkpoint
+        """
+        document_id = f'{name.obj_name(self)}:{self.topic_id}' + (':stale' if stale else '')
+        return self.db.collection(self.checkpoint_collection).document(document_id)
+
+    async def _load_checkpoint(self, stale=False) -> typing.Optional['_Sweep']:
+        checkpoint = (await self.checkpoint_document(stale).get()).to_dict() or {}
+        sweep = _Sweep.from_token(checkpoint.get('resume'))
+        return sweep if sweep is not None and sweep.stale == stale else None
+
+    async def _save_checkpoint(self, sweep: '_Sweep'):
+        if sweep.done:
+            await self.checkpoint_document(sweep.stale).delete()
+            return
+        await self.checkpoint_document(sweep.stale).set({'resume': sweep.token(), **sweep.progress(), 'updated': self.now()})
+
+    async def _do_backfill(self, items_to_check):
+        """
+        Marks documents without updated.<topic_id> as never updated, so that stale_query finds them
+        """
+        writer = FirestoreBatchWriter(self.db, self.freshness_batch_size, self.freshness_flush_interval, 'backfill_')
         collected_metrics = defaultdict(int)
-        for item_id, item in items_to_update:
-            kwargs['item_id'] = item_id
-            await self._do_update_one(collected_metrics, item=item, **kwargs)
+        async for item_id, item in _iterate(items_to_check):
+            collected_metrics['scanned'] += 1
+            if ((item or {}).get('updated') or {}).get(self.topic_id) is not None:
+                continue
+            await writer.set(self.collection.document(item_id), {'updated': {self.topic_id: START_OF_EPOCH}})
+        await writer.flush()
+        collected_metrics.update(writer.metrics)
         return collected_metrics
 
     async def _do_update_one(self, collected_metrics, item_id, item, **kwargs):
@@ -302,7 +771,7 @@ class QueueUpdateHandler(RequestHandler, ABC):
             if isinstance(metrics, dict):
                 for k, v in metrics.items():
                     collected_metrics[k] += v
-            await self.collection.document(item_id).set({'updated': {self.topic_id: self.now()}}, merge=True)
+            await self.mark_updated(item_id)
 
         # Exceptions that are not actually errors just warnings
         except HttpNotFoundError:
@@ -344,4 +813,22 @@ class QueueUpdateHandler(RequestHandler, ABC):
                     f"unexpected error for request {self.request} body {self.request.body}: {e}"),
                 exc_info=e
             )
-            raise e
\ No newline at end of file
+            raise e
+
+
+async def _iterate(items) -> typing.AsyncIterator:
+    """
+    Iterates over items() result whether it is an async iterator, an awaitable or a plain iterable
+    """
+    if inspect.isawaitable(items):
+        items = await items
+    if hasattr(items, '__aiter__'):
+        try:
+            async for item in items:
+                yield item
+        finally:
+            if hasattr(items, 'aclose'):
+                await items.aclose()
+        return
+    for item in items:
+        yield item
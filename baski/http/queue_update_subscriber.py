@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import typing
+from collections import defaultdict
+
+from google.cloud import pubsub
+from tornado.httputil import HTTPServerRequest
+from tornado.web import Application, HTTPError
+
+from .queue_update_handler import QueueUpdateHandler
+
+__all__ = ['QueueUpdateSubscriber']
+
+
+class QueueUpdateSubscriber(object):
+    '''
+    Runs QueueUpdateHandler from a streaming pull subscription instead of HTTP push
+    1. Flow control limits outstanding messages and bytes
+    2. Message is acked whenever push would answer 2xx, otherwise it is nacked for redelivery
+    3. stop() nacks new messages, waits for in-flight ones and then closes the stream
+    '''
+
+    def __init__(
+            self,
+            handler_class: typing.Type[QueueUpdateHandler],
+            subscription: str,
+            subscriber: pubsub.SubscriberClient = None,
+            max_messages=100,
+            max_bytes=10 * 1024 * 1024,
+            handler_kwargs: typing.Dict = None
+    ):
+        self.handler_class = handler_class
+        self.subscription = subscription
+        self.subscriber = subscriber
+        self.flow_control = pubsub.types.FlowControl(max_messages=max_messages, max_bytes=max_bytes)
+        self.handler_kwargs = handler_kwargs or {}
+        self.metrics = defaultdict(int)
+        self._application = Application()
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._streaming_pull = None
+        self._tasks: typing.Set[asyncio.Task] = set()
+        self._stopping = False
+
+    @property
+    def name(self):
+        return f'{self.handler_class.__name__}[{self.subscription}]'
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        self._loop = loop or asyncio.get_event_loop()
+        self.subscriber = self.subscriber or pubsub.SubscriberClient()
+        self._streaming_pull = self.subscriber.subscribe(
+            self.subscription, callback=self._on_message, flow_control=self.flow_control)
+        logging.info(f'Pull {self.name}')
+
+    def stop(self):
+        self._stopping = True
+        if not self._tasks:
+            self._close()
+
+    def owns(self, task: asyncio.Task) -> bool:
+        return task in self._tasks
+
+    def _close(self):
+        if self._streaming_pull is None:
+            return
+        streaming_pull, self._streaming_pull = self._streaming_pull, None
+        streaming_pull.cancel()
+        logging.info(f'Stopped {self.name}: {dict(self.metrics)}')
+
+    def _on_message(self, message):
+        # Called from the subscriber thread
+        self._loop.call_soon_threadsafe(self._spawn, message)
+
+    def _spawn(self, message):
+        if self._stopping:
+            message.nack()
+            return
+        task = self._loop.create_task(self._handle(message))
+        self._tasks.add(task)
+
+    async def _handle(self, message):
+        task = asyncio.current_task()
+        try:
+            handler = self.handler_class(self._application, _detached_request(self.subscription), **self.handler_kwargs)
+            collected_metrics = await handler.process_message(
+                dict(message.attributes or {}), message.data or None, message.message_id)
+        except HTTPError as e:
+            logging.info(f'{self.name} nack {message.message_id}: {e}')
+            self.metrics['nacked'] += 1
+            message.nack()
+        except Exception as e:
+            logging.error(f'{self.name} nack {message.message_id}: {e}', exc_info=e)
+            self.metrics['nacked'] += 1
+            message.nack()
+        else:
+            self.metrics['acked'] += 1
+            for k, v in collected_metrics.items():
+                self.metrics[k] += v
+            message.ack()
+        finally:
+            self._tasks.discard(task)
+            if self._stopping and not self._tasks:
+                self._close()
+
+
+class _DetachedConnection(object):
+
+    def set_close_callback(self, callback):
+        pass
+
+
+def _detached_request(subscription) -> HTTPServerRequest:
+    return HTTPServerRequest(method='POST', uri=f'/{subscription}', connection=_DetachedConnection())
@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import pickle
+import time
+import typing
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+import aiohttp
+
+from ..concurrent import as_async
+from ..primitives import json
+from ..primitives.lru import LruCache
+
+__all__ = ['ResponseCache', 'CachedResponse']
+
+
+class CachedResponse(object):
+    __slots__ = ('result', 'size', 'expires_at', 'etag', 'last_modified')
+
+    def __init__(self, result, size, ttl, etag=None, last_modified=None):
+        self.result = result
+        self.size = size
+        self.expires_at = time.time() + ttl
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def fresh(self) -> bool:
+        return self.expires_at > time.time()
+
+    @property
+    def revalidatable(self) -> bool:
+        return bool(self.etag or self.last_modified)
+
+    def conditional_headers(self) -> typing.Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers[aiohttp.hdrs.IF_NONE_MATCH] = self.etag
+        if self.last_modified:
+            headers[aiohttp.hdrs.IF_MODIFIED_SINCE] = self.last_modified
+        return headers
+
+    def refresh(self, ttl):
+        self.expires_at = time.time() + ttl
+
+
+class ResponseCache(object):
+    '''
+    Cache of parsed HttpClient results
+    1. In-memory LRU tier limited by the total size of response bodies
+    2. Optional on-disk tier in directory, it survives restarts and is shared by processes
+    3. Expired entry with ETag or Last-Modified is revalidated, 304 returns the cached result
+    4. Hit, miss and revalidation counters per base url
+    Cached results are shared between callers, treat them as read only.
+    '''
+
+    def __init__(self, ttl=5 * 60, max_bytes=64 * 1024 * 1024, max_entries=4096, directory=None):
+        self.ttl = ttl
+        self.directory = Path(directory) if directory else None
+        self.stats: typing.Dict[str, typing.Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._memory = LruCache(maxsize=max_entries, maxweight=max_bytes)
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(base_url, method, url, params) -> str:
+        request = json.dumps([base_url, method, str(url), {k: str(v) for k, v in (params or {}).items()}])
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    async def get(self, key) -> typing.Optional[CachedResponse]:
+        """
+        Returns fresh entry or expired one that can be revalidated
+        """
+        entry = self._memory.get(key)
+        if entry is None and self.directory:
+            entry = await as_async(self._read, key)
+            if entry is not None:
+                self._memory.set(key, entry, weight=entry.size)
+        if entry is None or entry.fresh or entry.revalidatable:
+            return entry
+        self._memory.pop(key)
+        return None
+
+    async def put(self, key, entry: CachedResponse):
+        self._memory.set(key, entry, weight=entry.size)
+        if self.directory:
+            await as_async(self._write, key, entry)
+
+    def count(self, base_url, event):
+        self.stats[base_url][event] += 1
+
+    def _path(self, key) -> Path:
+        return self.directory / f'{key}.pickle'
+
+    def _read(self, key) -> typing.Optional[CachedResponse]:
+        path = self._path(key)
+        try:
+            with path.open('rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ValueError) as e:
+            logging.warning(f"Broken http cache entry {path}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+
+    def _write(self, key, entry: CachedResponse):
+        path = self._path(key)
+        tmp_path = path.with_suffix(f'.{uuid.uuid4().hex}.tmp')
+        with tmp_path.open('wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(path)
@@ -0,0 +1,97 @@
+import asyncio
+import functools
+import logging
+import ssl
+import typing
+
+import aiohttp
+
+from .metrics import HttpMetrics
+from ..pattern import Singleton
+
+__all__ = ['SessionPool', 'ssl_context', 'get_cipher_list']
+
+
+@functools.lru_cache()
+def get_cipher_list():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    return [cipher['name'] for cipher in context.get_ciphers()]
+
+
+@functools.lru_cache()
+def ssl_context() -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    context.set_ciphers(":".join(get_cipher_list()))
+    return context
+
+
+class SessionPool(metaclass=Singleton):
+    '''
+    Process wide aiohttp sessions
+    1. One session per base url and proxy, it lives until close() regardless of HttpClient instances
+    2. All sessions share one keep-alive connector with DNS cache and per host limit
+    3. Sessions are bound to the event loop, new loop gets new sessions and unclosed old ones are dropped with a warning
+    4. Sessions report timings to HttpMetrics
+    '''
+
+    limit = 256
+    limit_per_host = 32
+    keepalive_timeout = 30
+    ttl_dns_cache = 300
+
+    def __init__(self):
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._connector: typing.Optional[aiohttp.TCPConnector] = None
+        self._sessions: typing.Dict[typing.Tuple, aiohttp.ClientSession] = {}
+
+    def session(self, base_url, proxy=None) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._forget_loop()
+            self._loop = loop
+
+        key = (base_url, proxy)
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                base_url=base_url,
+                connector=self.connector,
+                connector_owner=False,
+                trace_configs=[HttpMetrics().trace_config]
+            )
+            self._sessions[key] = session
+        return session
+
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+                ssl=ssl_context(),
+                enable_cleanup_closed=True
+            )
+        return self._connector
+
+    def _forget_loop(self):
+        # Sessions of another loop can't be used or closed from this one
+        sessions, self._sessions, self._connector = list(self._sessions.values()), {}, None
+        unclosed = [session for session in sessions if not session.closed]
+        for session in unclosed:
+            session.detach()
+        if unclosed:
+            logging.warning(f'Dropped {len(unclosed)} unclosed http sessions of the previous event loop, '
+                            f'await SessionPool().close() before the loop is closed')
+
+    async def close(self):
+        sessions, self._sessions = list(self._sessions.values()), {}
+        connector, self._connector = self._connector, None
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+        if connector is not None and not connector.closed:
+            await connector.close()
+        if sessions:
+            logging.info(f'Closed {len(sessions)} http sessions')
@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import random
+import typing
+from collections import defaultdict
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+__all__ = ['Fixture', 'FixtureStore', 'StandInServer']
+
+# Headers that describe the body as the client sees it, transport headers are not replayed
+_KEPT_HEADERS = (
+    aiohttp.hdrs.CONTENT_TYPE, aiohttp.hdrs.ETAG, aiohttp.hdrs.LAST_MODIFIED, aiohttp.hdrs.CACHE_CONTROL
+)
+
+Distribution = typing.Union[float, typing.Callable[[random.Random], float]]
+
+
+class Fixture(object):
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status: int, headers: typing.Dict[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class FixtureStore(object):
+    '''
+    Recorded responses on disk, <key>.json keeps request, status and headers, <key>.body keeps the body.
+    Key is the method and the path with query, so fixtures don't depend on the host
+    '''
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(method, path_qs) -> str:
+        return hashlib.sha256(f'{method} {path_qs}'.encode('utf-8')).hexdigest()[:32]
+
+    def load(self, method, path_qs) -> typing.Optional[Fixture]:
+        key = self.key(method, path_qs)
+        meta_path = self.directory / f'{key}.json'
+        if not meta_path.exists():
+            return None
+        meta = json.loads(meta_path.read_text())
+        return Fixture(meta['status'], meta['headers'], (self.directory / f'{key}.body').read_bytes())
+
+    def save(self, method, path_qs, fixture: Fixture):
+        key = self.key(method, path_qs)
+        (self.directory / f'{key}.body').write_bytes(fixture.body)
+        (self.directory / f'{key}.json').write_text(json.dumps({
+            'method': method, 'url': path_qs, 'status': fixture.status, 'headers': fixture.headers
+        }, indent=2))
+
+
+class StandInServer(object):
+    '''
+    In-process aiohttp server that stands in for an upstream in tests and benchmarks
+    1. Replays fixtures, missing ones are recorded from upstream origin when it is given
+    2. Without a fixture and upstream responds with a synthetic JSON body of size bytes or 404
+    3. latency, error_rate and size are numbers or functions of random.Random, see lognormal()
+    4. routes are served before fixtures, e.g. to emulate an API
+    Use it as `async with StandInServer(...) as base_url`
+    '''
+
+    def __init__(
+            self,
+            fixtures: typing.Union[str, Path, FixtureStore] = None,
+            upstream: str = None,
+            latency: Distribution = 0.0,
+            error_rate=0.0,
+            error_status=503,
+            size: Distribution = None,
+            routes: typing.Iterable[web.RouteDef] = (),
+            seed=None,
+            host='127.0.0.1',
+            port=0
+    ):
+        self.fixtures = fixtures if isinstance(fixtures, FixtureStore) or fixtures is None else FixtureStore(fixtures)
+        self.upstream = upstream
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.size = size
+        self.stats = defaultdict(int)
+        self.base_url = None
+        self._routes = list(routes)
+        self._random = random.Random(seed)
+        self._host = host
+        self._port = port
+        self._runner: typing.Optional[web.AppRunner] = None
+        self._upstream_session: typing.Optional[aiohttp.ClientSession] = None
+
+    @staticmethod
+    def lognormal(median, sigma=0.5) -> typing.Callable[[random.Random], float]:
+        return lambda rng: median * math.exp(sigma * rng.gauss(0, 1))
+
+    async def __aenter__(self) -> str:
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    async def start(self) -> str:
+        app = web.Application(middlewares=[self._conditions])
+        app.add_routes(self._routes + [web.route('*', '/{tail:.*}', self._serve)])
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self._host, self._port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{self._host}:{port}'
+        logging.info(f'Stand-in server at {self.base_url}')
+        return self.base_url
+
+    async def stop(self):
+        if self._upstream_session is not None:
+            await self._upstream_session.close()
+            self._upstream_session = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _draw(self, value: Distribution) -> float:
+        return value(self._random) if callable(value) else value
+
+    @web.middleware
+    async def _conditions(self, request: web.Request, handler):
+        self.stats['requests'] += 1
+        latency = self._draw(self.latency)
+        if latency > 0:
+            await asyncio.sleep(latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return web.Response(status=self.error_status)
+        return await handler(request)
+
+    async def _serve(self, request: web.Request) -> web.StreamResponse:
+        fixture = self.fixtures.load(request.method, request.path_qs) if self.fixtures else None
+        if fixture is not None:
+            self.stats['replayed'] += 1
+        elif self.upstream:
+            fixture = await self._record(request)
+            self.stats['recorded'] += 1
+        elif self.size is not None:
+            self.stats['synthetic'] += 1
+            padding = 'x' * max(int(self._draw(self.size)) - 32, 0)
+            fixture = Fixture(200, {aiohttp.hdrs.CONTENT_TYPE: 'application/json'}, json.dumps({
+                'path': request.path, 'data': padding
+            }).encode('utf-8'))
+        else:
+            raise web.HTTPNotFound()
+
+        etag = fixture.headers.get(aiohttp.hdrs.ETAG)
+        if etag and request.headers.get(aiohttp.hdrs.IF_NONE_MATCH) == etag:
+            return web.Response(status=304, headers={aiohttp.hdrs.ETAG: etag})
+        return web.Response(status=fixture.status, headers=fixture.headers, body=fixture.body)
+
+    async def _record(self, request: web.Request) -> Fixture:
+        if self._upstream_session is None:
+            self._upstream_session = aiohttp.ClientSession(base_url=self.upstream)
+        skip = (aiohttp.hdrs.HOST, aiohttp.hdrs.CONTENT_LENGTH)
+        headers = {k: v for k, v in request.headers.items() if k not in skip}
+        async with self._upstream_session.request(
+                request.method, request.path_qs, headers=headers, data=await request.read()
+        ) as response:
+            fixture = Fixture(
+                response.status,
+                {k: response.headers[k] for k in _KEPT_HEADERS if k in response.headers},
+                await response.read()
+            )
+        if self.fixtures:
+            self.fixtures.save(request.method, request.path_qs, fixture)
+        return fixture
+
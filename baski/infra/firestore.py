@@ -0,0 +1,25 @@
+import json
+import typing
+from pathlib import Path
+
+__all__ = ['staleness_indexes', 'dump_staleness_indexes']
+
+
+def staleness_indexes(handlers: typing.Iterable) -> dict:
+    """
+    firestore.indexes.json content with composite indexes required by QueueUpdateHandler.stale_query
+    """
+    indexes = []
+    for handler in handlers:
+        index = handler.staleness_index()
+        if index not in indexes:
+            indexes.append(index)
+    return {"indexes": indexes, "fieldOverrides": []}
+
+
+def dump_staleness_indexes(handlers: typing.Iterable, file_path='firestore.indexes.json'):
+    """
+    Writes indexes for `firebase deploy --only firestore:indexes`
+    """
+    Path(file_path).write_text(json.dumps(staleness_indexes(handlers), indent=2))
+    print(f"Firestore indexes are written to {file_path}")
@@ -0,0 +1,70 @@
+import typing
+
+__all__ = ['Histogram']
+
+
+class Histogram(object):
+    '''
+    HDR-style log-linear histogram. Values are counted in units of resolution, every power of two is split
+    into precision / 2 buckets, so relative error of percentiles is below 2 / precision.
+    Memory is proportional to the number of distinct buckets, record() is O(1)
+    '''
+    __slots__ = ('resolution', 'count', 'total', 'max', '_bits', '_half', '_buckets')
+
+    def __init__(self, resolution=1e-6, precision=64):
+        assert precision >= 2 and precision & (precision - 1) == 0, 'precision must be a power of two'
+        self.resolution = resolution
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._bits = precision.bit_length() - 1
+        self._half = precision // 2
+        self._buckets: typing.Dict[int, int] = {}
+
+    def record(self, value, count=1):
+        units = max(int(value / self.resolution), 0)
+        shift = max(units.bit_length() - self._bits, 0)
+        index = shift * self._half + (units >> shift)
+        self._buckets[index] = self._buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q) -> float:
+        """
+        Upper bound of the bucket that holds q percent of values
+        """
+        if not self.count:
+            return 0.0
+        rank = max(self.count * q / 100, 1)
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def merge(self, other: 'Histogram'):
+        assert (self.resolution, self._bits) == (other.resolution, other._bits)
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def summary(self, percentiles=(50, 90, 99)) -> typing.Dict[str, float]:
+        result = {'count': self.count, 'mean': self.mean, 'max': self.max}
+        for q in percentiles:
+            result[f'p{q}'] = self.percentile(q)
+        return result
+
+    def _upper(self, index) -> float:
+        if index < 2 * self._half:
+            return (index + 1) * self.resolution
+        shift = index // self._half - 1
+        return ((index - shift * self._half + 1) << shift) * self.resolution
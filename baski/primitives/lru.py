@@ -0,0 +1,62 @@
+import time
+import typing
+from collections import OrderedDict
+
+__all__ = ['LruCache']
+
+_MISSING = object()
+
+
+class LruCache(object):
+    '''
+    Mapping that keeps at most maxsize recently used entries and at most maxweight of their total weight.
+    Entries expire after ttl seconds (per cache or per entry), expired entries are dropped on access.
+    '''
+
+    def __init__(
+            self, maxsize=1024, ttl: typing.Optional[float] = None, maxweight: typing.Optional[int] = None,
+            clock=time.monotonic
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weight = 0
+        self._clock = clock
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        expires_at, value, _ = entry
+        if expires_at is not None and expires_at <= self._clock():
+            self.pop(key)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: typing.Optional[float] = None, weight=1):
+        ttl = self.ttl if ttl is None else ttl
+        self.pop(key)
+        self._data[key] = (self._clock() + ttl if ttl else None, value, weight)
+        self.weight += weight
+        while len(self._data) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight):
+            _, (_, _, evicted_weight) = self._data.popitem(last=False)
+            self.weight -= evicted_weight
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        self.weight -= entry[2]
+        return entry[1]
+
+    def clear(self):
+        self._data.clear()
+        self.weight = 0
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
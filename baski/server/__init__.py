@@ -1,3 +1,4 @@
 from .async_server import *
 from .tornado_server import *
+from .subscriber_server import *
 from .aiogram_server import *
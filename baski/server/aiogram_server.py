@@ -113,7 +113,7 @@ class TelegramServer(AsyncServer):
 
     def execute_pooling(self):
         self.loop.run_until_complete(self.bot.delete_webhook(drop_pending_updates=False))
-        executor.start_polling(self.dp)
+        executor.start_polling(self.dp, on_shutdown=self.on_shutdown)
 
     def execute_webhook(self):
         parts = urlparse(self.args['webhook_path'])
@@ -122,6 +122,8 @@ class TelegramServer(AsyncServer):
         web_app: web.Application = self.executor.web_app
 
         web_app.on_startup.append(self.register_webhook)
+        # run_app closes the loop, so the shutdown hook runs on the app cleanup
+        web_app.on_cleanup.append(self.on_shutdown)
 
         web_app.add_routes(self.web_routes() + [
             web.get('/webhook', self.register_webhook),
@@ -14,6 +14,7 @@ from google.cloud import firestore
 from google.cloud import logging as cloud_logging
 
 from ..config import AppConfig
+from ..http import SessionPool
 from ..env import is_debug, is_test, is_cloud, port, get_env
 
 __all__ = ['AsyncServer']
@@ -178,10 +179,17 @@ class AsyncServer(metaclass=abc.ABCMeta):
         local_logging.root.addHandler(ch)
         local_logging.root.setLevel(logging.DEBUG if debug else logging.INFO)
 
+    async def on_shutdown(self, *args):
+        """
+        Releases process wide resources bound to the loop, called after the server has stopped serving
+        """
+        await SessionPool().close()
+
     def execute(self):
         with self.loop_executor:
             try:
                 return self.loop.run_forever()
             finally:
+                self.loop.run_until_complete(self.on_shutdown())
                 self.loop.close()
 
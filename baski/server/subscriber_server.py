@@ -0,0 +1,36 @@
+import abc
+import asyncio
+import typing
+
+from ..http import QueueUpdateSubscriber
+from .async_server import AsyncServer
+
+__all__ = ['SubscriberServer']
+
+
+class SubscriberServer(AsyncServer):
+    '''
+    Runs QueueUpdateHandler subclasses from pull subscriptions. SIGTERM drains in-flight messages
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.subscribers: typing.List[QueueUpdateSubscriber] = []
+
+    @abc.abstractmethod
+    def subscriptions(self) -> typing.List[QueueUpdateSubscriber]:
+        raise NotImplementedError()
+
+    def init(self, *args, **kwargs):
+        super().init(*args, **kwargs)
+        self.subscribers = self.subscriptions()
+        for subscriber in self.subscribers:
+            subscriber.start(self.loop)
+
+    def stop(self):
+        for subscriber in self.subscribers:
+            subscriber.stop()
+        super().stop()
+
+    def should_wait_task(self, t: asyncio.Task):
+        return any(s.owns(t) for s in self.subscribers) or super().should_wait_task(t)
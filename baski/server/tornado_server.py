@@ -3,7 +3,7 @@ import logging
 
 from tornado.web import Application as WebApplication
 
-from ..http import OkHandler, ThreadHandler
+from ..http import OkHandler, ThreadHandler, HttpMetricsHandler
 from .async_server import AsyncServer
 
 
@@ -28,6 +28,7 @@ class TornadoServer(AsyncServer):
         handlers.append(['/ping', OkHandler])
         handlers.append(['/', OkHandler])
         handlers.append(['/threads', ThreadHandler])
+        handlers.append(['/http_metrics', HttpMetricsHandler])
 
         self.web_app = WebApplication(handlers=handlers, compress_response=True)
         self.web_app.listen(self.args['port'], backlog=4096, reuse_port=True)
@@ -0,0 +1,175 @@
+"""
+HttpClient benchmarks against the in-process stand-in server
+
+    python -m benchmarks.http_client --output report.json
+    python -m benchmarks.http_client --baseline report.json --tolerance 0.3
+
+With --baseline the exit code is 1 when requests/s, p99 or loop lag of any scenario regress more than tolerance
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import typing
+from pathlib import Path
+
+from aiohttp import web
+
+from baski.concurrent import RateLimiter
+from baski.http import HttpClient, HttpException, SessionPool, StandInServer
+from baski.primitives.histogram import Histogram
+
+# openai client is imported with baski.clients and requires the key
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+from baski.clients.scrapfly_client import ScrapflyClient  # noqa: E402
+
+
+class LoopLag(object):
+    """
+    Measures how late the event loop wakes up a sleeping coroutine
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.histogram = Histogram()
+        self._task = None
+
+    async def _tick(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.histogram.record(max(time.perf_counter() - started - self.interval, 0))
+
+    def __enter__(self):
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._task.cancel()
+
+
+async def measure(name, calls: typing.Iterable[typing.Callable[[], typing.Awaitable]], concurrency) -> typing.Dict:
+    latency = Histogram()
+    errors = 0
+    calls = iter(calls)
+
+    async def worker():
+        nonlocal errors
+        for call in calls:
+            started = time.perf_counter()
+            try:
+                await call()
+            except HttpException:
+                errors += 1
+            latency.record(time.perf_counter() - started)
+
+    with LoopLag() as lag:
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        seconds = time.perf_counter() - started
+
+    return {
+        'scenario': name,
+        'requests': latency.count,
+        'errors': errors,
+        'rps': latency.count / seconds,
+        'p50': latency.percentile(50),
+        'p99': latency.percentile(99),
+        'loop_lag_p99': lag.histogram.percentile(99),
+        'loop_lag_max': lag.histogram.max,
+    }
+
+
+async def bench_fetch(requests, concurrency):
+    async with StandInServer(latency=StandInServer.lognormal(0.005), size=2048, seed=1) as base_url:
+        client = HttpClient(base_url)
+        return await measure('fetch', (lambda i=i: client.fetch(f'/item/{i}') for i in range(requests)), concurrency)
+
+
+async def bench_retries(requests, concurrency):
+    async with StandInServer(latency=0.002, error_rate=0.2, size=2048, seed=1) as base_url:
+        client = HttpClient(base_url)
+        return await measure('retries', (lambda: client.fetch('/item') for _ in range(requests)), concurrency)
+
+
+async def bench_rate_limiter(requests, concurrency, rate=500.0):
+    async with StandInServer(size=256) as base_url:
+        client = HttpClient(base_url, rate_limiter=RateLimiter(rate, burst=10))
+        result = await measure('rate_limiter', (lambda: client.fetch('/item') for _ in range(requests)), concurrency)
+        result['target_rps'] = rate
+        return result
+
+
+async def bench_scrapfly(requests, concurrency):
+    async def scrape(request: web.Request):
+        # Every other domain needs JS rendering
+        needs_js = request.query['url'].endswith('1')
+        success = not needs_js or request.query['render_js'] == 'true'
+        return web.json_response({'result': {'success': success, 'status_code': 200 if success else 403}})
+
+    async with StandInServer(latency=0.005, routes=[web.get('/scrape', scrape)]) as base_url:
+        client = ScrapflyClient('key', req_interval_sec=0, base_url=base_url)
+        calls = (lambda i=i: client.fetch(f'https://site{i}.com/{i % 2}') for i in range(requests))
+        return await measure('scrapfly', calls, concurrency)
+
+
+SCENARIOS = {
+    'fetch': bench_fetch,
+    'retries': bench_retries,
+    'rate_limiter': bench_rate_limiter,
+    'scrapfly': bench_scrapfly,
+}
+
+
+async def run(scenarios, requests, concurrency) -> typing.List[typing.Dict]:
+    report = []
+    try:
+        for name in scenarios:
+            report.append(await SCENARIOS[name](requests, concurrency))
+    finally:
+        await SessionPool().close()
+    return report
+
+
+def regressions(report, baseline, tolerance) -> typing.List[str]:
+    previous = {r['scenario']: r for r in baseline}
+    found = []
+    for result in report:
+        before = previous.get(result['scenario'])
+        if not before:
+            continue
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            found.append(f"{result['scenario']} rps {before['rps']:.0f} -> {result['rps']:.0f}")
+        for key in ('p99', 'loop_lag_p99'):
+            # Ignore sub-millisecond noise
+            if result[key] > max(before[key] * (1 + tolerance), before[key] + 0.001):
+                found.append(f"{result['scenario']} {key} {before[key]:.4f} -> {result[key]:.4f}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HttpClient benchmarks')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='All scenarios by default')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--output', help='Write the report to this file')
+    parser.add_argument('--baseline', help='Compare with this report')
+    parser.add_argument('--tolerance', type=float, default=0.3)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.scenario or list(SCENARIOS), args.requests, args.concurrency))
+    for result in report:
+        print(json.dumps(result))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.baseline:
+        found = regressions(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for line in found:
+            print(f'Regression: {line}', file=sys.stderr)
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+import os
+
+# baski.clients imports the openai client, which requires the key
+os.environ.setdefault('OPENAI_API_KEY', 'test')
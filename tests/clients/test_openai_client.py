@@ -0,0 +1,129 @@
+import asyncio
+from unittest import mock
+
+import openai
+import pytest
+
+from baski.clients import OpenAiClient, TokenCounter
+
+
+class FakeStream:
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    async def __aiter__(self):
+        for piece in self.pieces:
+            yield {'choices': [{'finish_reason': None, 'delta': {'content': piece}}]}
+        yield {'choices': [{'finish_reason': 'stop', 'delta': {}}]}
+
+
+def _answer(client, yield_mode, pieces):
+    async def create(**kwargs):
+        return FakeStream(pieces)
+
+    async def main():
+        with mock.patch('openai.ChatCompletion.acreate', create):
+            return [text async for text in client.from_prompt(1, 'hi', yield_mode=yield_mode)]
+
+    return asyncio.run(main())
+
+
+def test_cumulative_and_delta_modes():
+    client = OpenAiClient(api_key='test', chunk_length=4)
+    pieces = ['Hel', 'lo ', 'wor', 'ld\n', 'bye']
+    assert _answer(client, 'cumulative', pieces) == ['Hello ', 'Hello world\n', 'Hello world\nbye']
+    assert _answer(client, 'delta', pieces) == ['Hello ', 'world\n', 'bye']
+
+
+def test_gather_joins_deltas():
+    client = OpenAiClient(api_key='test', chunk_length=2)
+
+    async def create(**kwargs):
+        return FakeStream(['a', 'bc', 'd\n', 'e'])
+
+    async def main():
+        with mock.patch('openai.ChatCompletion.acreate', create):
+            return await client.from_prompt(1, 'hi', streaming=False)
+
+    assert asyncio.run(main()) == 'abcd\ne'
+
+
+class BrokenStream(FakeStream):
+    async def __aiter__(self):
+        yield {'choices': [{'finish_reason': None, 'delta': {'content': self.pieces[0]}}]}
+        raise openai.error.APIConnectionError('connection reset')
+
+
+def test_stream_broken_midway():
+    client = OpenAiClient(api_key='test', chunk_length=2)
+    attempts = []
+
+    async def create(**kwargs):
+        attempts.append(1)
+        pieces = ['first\n', 'second\n']
+        return BrokenStream(pieces) if len(attempts) == 1 else FakeStream(pieces)
+
+    async def gather():
+        return await client.from_prompt(1, 'hi', streaming=False)
+
+    async def deltas():
+        return [text async for text in client.from_prompt(1, 'hi', yield_mode='delta')]
+
+    def run(coro_fn):
+        attempts.clear()
+        with mock.patch('openai.ChatCompletion.acreate', create), mock.patch('asyncio.sleep', mock.AsyncMock()):
+            return asyncio.run(coro_fn())
+
+    # Non-streaming call retries and returns the whole new answer
+    assert run(gather) == 'first\nsecond\n'
+    assert len(attempts) == 2
+    # Delta consumer has got a part of the answer already, so the error is raised
+    with pytest.raises(openai.error.APIConnectionError):
+        run(deltas)
+    assert len(attempts) == 1
+
+
+class WordEncoder:
+    name = 'words'
+
+    def encode(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return ' '.join(tokens)
+
+
+def test_history_is_packed_into_context_window():
+    TokenCounter.register('packed-model', WordEncoder())
+    telemetry = mock.Mock()
+    client = OpenAiClient(
+        api_key='test', system_prompt='be brief', default_cgi={'model': 'packed-model'}, telemetry=telemetry)
+    client.context_windows = {'packed-model': 40}
+    client.output_reserve, client.message_overhead, client.reply_overhead = 10, 0, 0
+    history = [
+        {'role': 'user', 'content': ' '.join(f'old{i}' for i in range(20))},
+        {'role': 'assistant', 'content': ' '.join(['mid'] * 10)},
+        {'role': 'user', 'content': ' '.join(['new'] * 12)},
+    ]
+    sent = []
+
+    async def create(messages, **kwargs):
+        sent.append(messages)
+        return FakeStream(['ok'])
+
+    async def main():
+        with mock.patch('openai.ChatCompletion.acreate', create):
+            for min_truncated in (2, 6):
+                client.min_truncated_tokens = min_truncated
+                await client.from_prompt(1, 'hi', history=history, streaming=False)
+
+    asyncio.run(main())
+    truncated, dropped = sent
+    assert truncated[0]['role'] == 'system' and truncated[-1]['content'] == 'hi'
+    assert truncated[1]['content'] == 'old15 old16 old17 old18 old19'
+    assert truncated[2:4] == history[1:]
+    assert dropped[1:] == history[1:] + [{'role': 'user', 'content': 'hi'}]
+
+    payloads = [c.kwargs['payload'] for c in telemetry.add.call_args_list if c.kwargs['event_type'] == 'openai_in_text']
+    assert payloads[0] | {'history_tokens_saved': 15, 'history_turns_dropped': 0} == payloads[0]
+    assert payloads[1]['history_tokens_saved'] == 20 and payloads[1]['history_turns_dropped'] == 1
@@ -0,0 +1,75 @@
+from aiohttp import web
+
+from baski.clients import ScrapflyClient
+from baski.http import StandInServer
+
+
+def test_remembers_tier_per_domain(run_http):
+    calls = []
+
+    async def scrape(request):
+        calls.append((request.query['asp'], request.query['render_js']))
+        success = 'js.com' not in request.query['url'] or request.query['render_js'] == 'true'
+        return web.json_response({'result': {'success': success, 'content': 'page'}})
+
+    class Client(ScrapflyClient):
+        reprobe_rate = 0.0
+
+    # Stats are shared by all clients of the process
+    ScrapflyClient.stats.clear()
+
+    async def main():
+        async with StandInServer(routes=[web.get('/scrape', scrape)]) as base_url:
+            client = Client('key', req_interval_sec=0, base_url=base_url)
+            assert (await client.fetch('https://js.com/a'))['content'] == 'page'
+            assert calls == [('false', 'false'), ('false', 'true')]
+            calls.clear()
+            await client.fetch('https://js.com/b')
+            assert calls == [('false', 'true')]
+
+            calls.clear()
+            Client.reprobe_rate = 1.0
+            await client.fetch('https://js.com/c')
+            assert calls == [('false', 'false'), ('false', 'true')]
+
+            # Caller that requires rendering is never reprobed below it
+            calls.clear()
+            await client.fetch('https://js.com/d', render_js=True)
+            assert calls == [('false', 'true')]
+
+    run_http(main())
+    stats = Client.tier_stats()
+    assert stats['render_js']['successes'] == 4
+    assert stats['plain']['success_rate'] == 0
+    assert stats['memory'] == {'hits': 3, 'reprobes': 1}
+    assert Client.tier_memory() is not ScrapflyClient.tier_memory()
+
+
+def test_backs_off_on_concurrency_errors(run_http):
+    requests = []
+
+    async def scrape(request):
+        requests.append(request.query['url'])
+        if len(requests) == 1:
+            return web.json_response({'error': 'ERR::THROTTLE::MAX_CONCURRENT_REQUEST_EXCEEDED'}, status=429)
+        return web.json_response({'result': {'success': True, 'content': 'page'}})
+
+    class Client(ScrapflyClient):
+        backoff_base = 0.01
+
+    async def main():
+        async with StandInServer(routes=[web.get('/scrape', scrape)]) as base_url:
+            client = Client('throttled', base_url=base_url, concurrency=4)
+            assert (await client.fetch('https://site.com/', priority=Client.PRIORITY_BATCH))['content'] == 'page'
+            assert client.slots.limit == 3
+
+    run_http(main())
+    assert len(requests) == 2
+
+
+def test_tier_memory_is_built_per_class():
+    class Small(ScrapflyClient):
+        tier_memory_size = 2
+
+    assert Small.tier_memory().maxsize == 2
+    assert ScrapflyClient.tier_memory().maxsize == ScrapflyClient.tier_memory_size
@@ -0,0 +1,43 @@
+import asyncio
+
+from baski.clients import TokenCounter
+
+
+class WordEncoder:
+    name = 'words'
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return text.split()
+
+
+def test_counts_are_cached_by_content():
+    encoder = WordEncoder()
+    TokenCounter.register('test-model', encoder)
+    counter = TokenCounter()
+    messages = [{'role': 'system', 'content': 'be brief'}, {'role': 'user', 'content': 'hello there world'}]
+
+    async def main():
+        assert await counter.count_messages(messages, 'test-model-1') == 5
+        assert await counter.count_messages(messages + [{'role': 'user', 'content': 'again'}], 'test-model-1') == 6
+
+    asyncio.run(main())
+    assert encoder.encoded == ['be brief', 'hello there world', 'again']
+    assert counter.count('hello there world', 'test-model') == 3
+    assert len(encoder.encoded) == 3
+
+
+def test_large_batches_are_encoded_off_loop():
+    encoder = WordEncoder()
+    TokenCounter.register('big-model', encoder)
+    counter = TokenCounter()
+    counter.offload_chars = 10
+
+    async def main():
+        return await counter.count_many(['one two three', 'four five'], 'big-model')
+
+    assert asyncio.run(main()) == [3, 2]
+    assert TokenCounter.encoder('big-model-x') is encoder
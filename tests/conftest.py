@@ -0,0 +1,21 @@
+import asyncio
+
+import pytest
+
+from baski.http import SessionPool
+
+
+@pytest.fixture
+def run_http():
+    """
+    asyncio.run that closes the shared http sessions before the loop ends
+    """
+    def run(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await SessionPool().close()
+        return asyncio.run(main())
+
+    return run
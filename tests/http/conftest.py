@@ -0,0 +1,211 @@
+import contextlib
+import copy
+
+import pytest
+from aiohttp import web
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore_v1.field_path import FieldPath
+
+
+@pytest.fixture
+def serve():
+    """
+    `async with serve(handler) as base_url` serves the handler at /item
+    """
+    @contextlib.asynccontextmanager
+    async def run(handler):
+        app = web.Application()
+        app.add_routes([web.get('/item', handler)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        try:
+            yield f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+        finally:
+            await runner.cleanup()
+
+    return run
+
+
+@pytest.fixture
+def fake_firestore():
+    """
+    Factory of in-memory firestore clients, documents are given as {'collection/id': data}
+    """
+    return FakeFirestore
+
+
+_MISSING = object()
+
+
+def _value(data, path):
+    """
+    Value of a dotted field path like updated.`docs-update`, _MISSING if the document has no such field
+    """
+    for part in FieldPath.from_string(path).parts:
+        if not isinstance(data, dict) or part not in data:
+            return _MISSING
+        data = data[part]
+    return data
+
+
+def _merge(target, data):
+    for k, v in data.items():
+        if isinstance(v, dict) and isinstance(target.get(k), dict):
+            _merge(target[k], v)
+        else:
+            target[k] = copy.deepcopy(v)
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.id = path.split('/')[-1]
+
+    async def get(self, field_paths=None):
+        return FakeSnapshot(self.id, self.db.docs.get(self.path))
+
+    async def create(self, data):
+        if self.path in self.db.docs:
+            raise AlreadyExists(self.path)
+        self.db.docs[self.path] = copy.deepcopy(data)
+
+    async def set(self, data, merge=False):
+        if merge and self.path in self.db.docs:
+            _merge(self.db.docs[self.path], data)
+        else:
+            self.db.docs[self.path] = copy.deepcopy(data)
+
+    async def delete(self):
+        self.db.docs.pop(self.path, None)
+
+
+class FakeQuery:
+    """
+    Ordered by the order_by fields and then by document id like firestore.
+    Documents without an ordered or filtered field are left out, cursors must have every ordered field
+    """
+
+    def __init__(self, collection, orders=(), filters=(), cursor=None, limit=None, offset=0):
+        self.collection = collection
+        self.orders = orders
+        self.filters = filters
+        self.cursor = cursor
+        self._limit = limit
+        self._offset = offset
+
+    def _copy(self, **kwargs):
+        state = dict(orders=self.orders, filters=self.filters, cursor=self.cursor, limit=self._limit,
+                     offset=self._offset) | kwargs
+        return FakeQuery(self.collection, **state)
+
+    def order_by(self, field):
+        return self._copy(orders=self.orders + (field,))
+
+    def select(self, fields):
+        return self
+
+    def where(self, filter):
+        return self._copy(filters=self.filters + (filter,))
+
+    def start_after(self, cursor):
+        return self._copy(cursor=cursor)
+
+    def limit(self, n):
+        return self._copy(limit=n)
+
+    def offset(self, n):
+        return self._copy(offset=n)
+
+    def count(self):
+        query = self
+
+        class Aggregation:
+            async def get(self):
+                return [[type('Result', (), {'value': len(query._docs())})]]
+
+        return Aggregation()
+
+    def _key(self, doc_id, data):
+        return tuple(_value(data, f) for f in self.orders) + (doc_id,)
+
+    def _docs(self):
+        docs = [doc for doc in self.collection.documents() if _MISSING not in self._key(*doc)]
+        for f in self.filters:
+            ops = {'>=': lambda a, b: a >= b, '<': lambda a, b: a < b}
+            docs = [(i, d) for i, d in docs
+                    if _value(d, f.field_path) is not _MISSING and ops[f.op_string](_value(d, f.field_path), f.value)]
+        docs.sort(key=lambda doc: self._key(*doc))
+        if isinstance(self.cursor, FakeSnapshot):
+            after = self._key(self.cursor.id, self.cursor.to_dict())
+            docs = [doc for doc in docs if self._key(*doc) > after]
+        elif self.cursor is not None:
+            # Cursor by field values only
+            after = tuple(_value(self.cursor, f) for f in self.orders)
+            if _MISSING in after:
+                raise ValueError(f'Cursor {self.cursor} has no value for every field of {self.orders}')
+            docs = [doc for doc in docs if self._key(*doc)[:-1] > after]
+        docs = docs[self._offset:]
+        return docs[:self._limit] if self._limit is not None else docs
+
+    async def stream(self):
+        self.collection.db.reads += 1
+        for doc_id, data in self._docs():
+            yield FakeSnapshot(doc_id, copy.deepcopy(data))
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(self)
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id):
+        return FakeDocument(self.db, f'{self.name}/{doc_id}')
+
+    def documents(self):
+        prefix = f'{self.name}/'
+        return [(p[len(prefix):], d) for p, d in self.db.docs.items() if p.startswith(prefix)]
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, reference, data, merge=False):
+        self.writes.append((reference, data, merge))
+
+    async def commit(self):
+        if self.db.fail_commits:
+            raise RuntimeError('commit failed')
+        for reference, data, merge in self.writes:
+            await reference.set(data, merge=merge)
+        self.db.commits.append(len(self.writes))
+
+
+class FakeFirestore:
+    project = 'test'
+
+    def __init__(self, docs=None):
+        self.docs = docs or {}
+        self.commits = []
+        self.reads = 0
+        self.fail_commits = False
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from baski.http.batch_writer import FirestoreBatchWriter
+
+
+def test_commits_by_size_and_interval(fake_firestore):
+    db = fake_firestore()
+    writer = FirestoreBatchWriter(db, max_batch_size=3, flush_interval=0.01)
+
+    async def run():
+        for i in range(7):
+            await writer.set(db.collection('docs').document(str(i)), {'n': i})
+        # Two full batches are committed at once, the last write waits for the timer
+        assert db.commits == [3, 3]
+        await asyncio.sleep(0.05)
+        assert db.commits == [3, 3, 1]
+        await writer.flush()
+
+    asyncio.run(run())
+    assert len(db.docs) == 7
+    assert dict(writer.metrics) == {'writes': 7, 'batches': 3, 'batch_max': 3}
+
+
+def test_flush_raises_background_commit_error(fake_firestore):
+    db = fake_firestore()
+    db.fail_commits = True
+    writer = FirestoreBatchWriter(db, max_batch_size=10, flush_interval=0.01)
+
+    async def run():
+        await writer.set(db.collection('docs').document('a'), {'n': 1})
+        await asyncio.sleep(0.05)
+        with pytest.raises(RuntimeError, match='commit failed'):
+            await writer.flush()
+        # The error is reported once
+        await writer.flush()
+
+    asyncio.run(run())
+    assert db.commits == [] and not writer.metrics
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+
+import pytest
+from aiohttp import web
+
+from baski.http import HttpClient, HttpMetrics, HttpNotFoundError, SessionPool
+
+
+def test_coalesce_identical_requests(serve, run_http):
+    requests = []
+
+    async def handler(request):
+        requests.append(request.query.get('id'))
+        await asyncio.sleep(0.05)
+        if request.query.get('id') == 'missing':
+            raise web.HTTPNotFound()
+        return web.json_response({'id': request.query['id']})
+
+    async def main():
+        async with serve(handler) as base_url:
+            client = HttpClient(base_url)
+            results = await asyncio.gather(*[client.fetch('/item', id='a', coalesce=True) for _ in range(5)])
+            assert results == [{'id': 'a'}] * 5
+            assert results[0] is results[4]
+
+            results = await asyncio.gather(
+                *[client.fetch('/item', max_attempts=1, id='missing', coalesce=True) for _ in range(3)], return_exceptions=True)
+            assert all(isinstance(r, HttpNotFoundError) for r in results)
+
+            await asyncio.gather(*[client.fetch('/item', id='b') for _ in range(2)])
+
+    run_http(main())
+    assert requests == ['a', 'missing', 'b', 'b']
+
+
+def test_stream_xml_and_file(tmp_path, serve, run_http):
+    body = ('<root>' + ''.join(f'<item><id>{i}</id></item>' for i in range(1000)) + '</root>').encode()
+
+    async def handler(request):
+        response = web.StreamResponse(headers={'Content-Type': 'application/xml'})
+        await response.prepare(request)
+        for i in range(0, len(body), 1024):
+            await response.write(body[i:i + 1024])
+        await response.write_eof()
+        return response
+
+    async def main():
+        async with serve(handler) as base_url:
+            client = HttpClient(base_url)
+            items = [item async for _, item in client.stream_xml('/item', chunk_size=512)]
+            assert items == [{'id': str(i)} for i in range(1000)]
+
+            async for _, item in client.stream_xml('/item', backlog=1):
+                break
+            assert item == {'id': '0'}
+
+            assert await client.stream_to(tmp_path / 'feed.xml', '/item') == len(body)
+            assert (tmp_path / 'feed.xml').read_bytes() == body
+
+    run_http(main())
+
+
+def test_csv_as_frame(serve, run_http):
+    body = 'date,close\n' + ''.join(f'2024-01-{i + 1:02d},{i}.5\n' for i in range(20))
+
+    async def handler(request):
+        return web.Response(text=body, content_type='text/csv')
+
+    async def main():
+        async with serve(handler) as base_url:
+            client = HttpClient(base_url)
+            frame = await client.fetch('/item', as_frame={'dtype': {'close': 'float32'}, 'parse_dates': ['date']})
+            assert len(frame) == 20
+            assert str(frame['close'].dtype) == 'float32'
+            assert frame['date'].iloc[-1].day == 20
+            assert await client.fetch('/item') == body
+
+    run_http(main())
+
+
+def test_hedge_slow_request(serve, run_http):
+    requests = []
+
+    async def handler(request):
+        requests.append(len(requests))
+        if len(requests) == 1:
+            await asyncio.sleep(0.5)
+        return web.json_response({'attempt': len(requests)})
+
+    class HedgedClient(HttpClient):
+        hedge_fraction = 0.5
+
+    async def main():
+        async with serve(handler) as base_url:
+            client = HedgedClient(base_url)
+            assert await asyncio.wait_for(client.fetch('/item', hedge=0.05), 0.4) == {'attempt': 2}
+            assert dict(client.hedge_stats[client._host]) == {'requests': 1, 'hedged': 1, 'won': 1}
+
+            # Hedges are capped to the fraction of requests
+            requests.clear()
+            assert await client.fetch('/item', hedge=0.05) == {'attempt': 1}
+            assert client.hedge_stats[client._host]['hedged'] == 1
+
+    run_http(main())
+
+
+def test_metrics(serve, run_http):
+    async def handler(request):
+        return web.json_response({'id': 1}, status=int(request.query.get('status', 200)))
+
+    async def main():
+        async with serve(handler) as base_url:
+            client = HttpClient(base_url)
+            await client.fetch('/item')
+            with pytest.raises(HttpNotFoundError):
+                await client.fetch('/item', max_attempts=1, status=404)
+            # Parsed in a worker, so the loop is not blocked
+            client.offload_parse_bytes = 0
+            await client.fetch('/item')
+        return base_url
+
+    base_url = run_http(main())
+    metrics = HttpMetrics().snapshot()[base_url]
+    assert metrics['statuses'] == {200: 2, 404: 1}
+    assert metrics['latency']['total']['count'] == 3
+    assert metrics['latency']['parse']['count'] == 3
+    assert metrics['latency']['loop_blocked']['count'] == 2
+    assert f'http_client_requests_total{{base_url="{base_url}",status="404"}} 1' in HttpMetrics().prometheus()
+
+
+def test_fetch_many(serve, run_http):
+    in_flight = []
+
+    async def handler(request):
+        in_flight.append(1)
+        assert len(in_flight) <= 3
+        await asyncio.sleep(0.01 * (10 - int(request.query['id'])))
+        in_flight.pop()
+        if request.query['id'] in ('3', '4'):
+            raise web.HTTPNotFound()
+        return web.json_response(int(request.query['id']))
+
+    async def main():
+        async with serve(handler) as base_url:
+            client = HttpClient(base_url)
+            requests = [{'url': '/item', 'id': i, 'max_attempts': 1} for i in range(10)]
+            requests[3]['on_error'] = 'skip'
+            results = await client.fetch_many(requests, concurrency=3, on_error='return')
+            # Skipped 3 keeps its place, so results line up with requests
+            assert results[:4] == [0, 1, 2, None] and results[5:] == [5, 6, 7, 8, 9]
+            assert isinstance(results[4], HttpNotFoundError)
+
+            with pytest.raises(HttpNotFoundError):
+                await client.fetch_many(requests, concurrency=3)
+
+    run_http(main())
+
+
+def test_sessions_of_finished_loop_are_dropped(caplog):
+    async def open_session(close=False):
+        session = SessionPool().session('http://127.0.0.1:1')
+        if close:
+            await SessionPool().close()
+        return session
+
+    first = asyncio.run(open_session())
+    with caplog.at_level(logging.WARNING):
+        second = asyncio.run(open_session(close=True))
+    assert first.closed and second is not first
+    assert 'Dropped 1 unclosed http sessions' in caplog.text
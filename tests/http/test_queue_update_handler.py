@@ -0,0 +1,438 @@
+import asyncio
+import concurrent.futures
+import datetime
+import importlib.util
+import json
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+import pytest
+from tornado.httputil import HTTPServerRequest
+from tornado.web import Application, HTTPError
+
+from baski.http import QueueUpdateHandler
+from baski.http.queue_update_handler import START_OF_EPOCH, _Sweep
+from baski.http.queue_update_subscriber import _DetachedConnection
+
+
+class DocHandler(QueueUpdateHandler):
+    what = 'doc'
+    collection_name = 'docs'
+    topic_id = 'docs-update'
+    order_by = 'key'
+    publisher = None
+    db = None
+
+    async def update_one(self, item_id, item, **kwargs):
+        return {'updated_docs': 1}
+
+
+def _handler(db, query=None, **attributes):
+    """
+    Handler of a fresh subclass, so class-level state like dedup memory is not shared between tests
+    """
+    cls = type('TestDocHandler', (DocHandler,), {'db': db} | attributes)
+    request = HTTPServerRequest(
+        method='GET', uri='/docs?' + urlencode(query or {}), connection=_DetachedConnection())
+    return cls(Application(), request)
+
+
+def _docs(n, **data):
+    return {f'docs/{i:03}': {'key': i} | data for i in range(n)}
+
+
+def _updated(db):
+    return sorted(p for p, d in db.docs.items() if p.startswith('docs/') and 'docs-update' in d.get('updated', {}))
+
+
+def test_update_all_merges_worker_metrics(fake_firestore):
+    db = fake_firestore(_docs(10))
+    handler = _handler(db)
+
+    async def run():
+        return await handler._do_update_all(handler.items(), concurrency=3, **handler._all_arguments())
+
+    metrics = asyncio.run(run())
+    assert metrics['updated_docs'] == 10
+    assert metrics['freshness_writes'] == 10
+    assert len(_updated(db)) == 10
+
+
+def test_fatal_error_cancels_workers_and_flushes_markers(fake_firestore):
+    db = fake_firestore(_docs(10))
+    started, cancelled = [], []
+
+    async def update_one(self, item_id, item, **kwargs):
+        started.append(item_id)
+        if item['key'] == 3:
+            raise RuntimeError('fatal')
+        if item['key'] > 3:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(item_id)
+                raise
+        return {'updated_docs': 1}
+
+    handler = _handler(db, update_one=update_one)
+
+    async def run():
+        await handler._do_update_all(handler.items(), concurrency=3, **handler._all_arguments())
+
+    with pytest.raises(RuntimeError, match='fatal'):
+        asyncio.run(asyncio.wait_for(run(), 5))
+    # Workers that were waiting for slow items are cancelled, markers of finished items are committed
+    assert cancelled and set(cancelled) == set(started) - {'000', '001', '002', '003'}
+    assert _updated(db) == ['docs/000', 'docs/001', 'docs/002']
+
+
+class FakePublisher:
+    """
+    Confirms every message a bit later from the loop, messages with fail attribute are rejected
+    """
+
+    def __init__(self, delay=0.001):
+        self.delay = delay
+        self.published = []
+        self.pending = 0
+        self.max_pending = 0
+
+    def topic_path(self, project, topic):
+        return f'projects/{project}/topics/{topic}'
+
+    def publish(self, topic, data, **attributes):
+        future = concurrent.futures.Future()
+        self.published.append((time.monotonic(), attributes))
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+
+        def confirm():
+            self.pending -= 1
+            if json.loads(data or b'{}').get('fail'):
+                future.set_exception(RuntimeError('rejected'))
+            else:
+                future.set_result(str(len(self.published)))
+
+        asyncio.get_running_loop().call_later(self.delay, confirm)
+        return future
+
+
+def _get(handler):
+    asyncio.run(handler.get())
+    body = json.loads(b''.join(handler._write_buffer))
+    return handler.get_status(), body['result'] or body['error']
+
+
+def test_publish_keeps_in_flight_cap_and_counts_failures(fake_firestore):
+    docs = _docs(20)
+    docs['docs/005']['fail'] = True
+    db, publisher = fake_firestore(docs), FakePublisher(delay=0.01)
+    status, result = _get(_handler(db, {'rate': 10000}, publisher=publisher, publish_in_flight=4))
+    assert publisher.max_pending == 4
+    assert (result['published'], result['failed']) == (19, 1)
+    # Scheduler has to retry the call
+    assert status == 503
+
+
+def test_publish_is_paced_by_rate(fake_firestore):
+    db, publisher = fake_firestore(_docs(6)), FakePublisher()
+    status, result = _get(_handler(db, {'rate': 100}, publisher=publisher, publish_burst=1))
+    assert status == 200 and result['published'] == 6
+    sent = [t for t, _ in publisher.published]
+    assert sent[-1] - sent[0] >= 0.045
+
+
+def test_single_item_without_metrics_is_reported_as_updated(fake_firestore):
+    async def update_one(self, item_id, item, **kwargs):
+        return None
+
+    db = fake_firestore(_docs(3))
+    status, result = _get(_handler(db, {'id': '001'}, update_one=update_one))
+    assert result['updated'] == 1 and result['freshness_writes'] == 1
+    assert _updated(db) == ['docs/001']
+
+
+def test_arguments_are_cast_and_round_trip(fake_firestore):
+    calls = []
+
+    def batch():
+        calls.append(1)
+        return f'batch-{len(calls)}'
+
+    arguments = {'force': False, 'since': datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc), 'batch': batch}
+    first = _handler(fake_firestore(), {'force': 'true', 'obsolescence': '6'}, arguments=arguments)
+    args = first._cgi_arguments()
+    assert args['force'] is True and args['obsolescence'] == 6 and args['item_id'] is None
+
+    # Callable defaults are evaluated for every request
+    second = _handler(fake_firestore(), arguments=arguments)
+    assert second._cgi_arguments()['batch'] == f'batch-{len(calls)}' != args['batch']
+    assert second._all_arguments()['now'] >= args['now']
+
+    posted = second._post_arguments(since='2024-01-02T03:04:05+00:00', force='0')
+    assert posted['since'] == datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    assert posted['force'] is False
+
+    # Published attributes are cast back to the same values
+    attributes = first._publish_attributes(**args)
+    assert all(isinstance(v, str) for v in attributes.values())
+    assert first._post_arguments(**attributes) == args
+
+    with pytest.raises(HTTPError) as e:
+        first._post_arguments(unknown='1')
+    assert e.value.status_code == 422
+
+
+def test_sweep_token_round_trip(fake_firestore):
+    handler = _handler(fake_firestore())
+    updated = datetime.datetime(2024, 5, 6, 7, 8, 9, tzinfo=datetime.timezone.utc)
+    cursor = handler._cursor({'key': 42, 'updated': {'docs-update': updated}}, stale=True)
+    sweep = _Sweep(cursor, total=10)
+    sweep.processed = 5
+
+    resumed = _Sweep.from_token(sweep.token())
+    assert resumed.cursor == {'key': 42, 'updated': {'docs-update': updated}}
+    assert resumed.total == 15 and resumed.processed == 0
+    assert _Sweep.from_token(None) is None
+    with pytest.raises(ValueError):
+        _Sweep.from_token('not a token')
+
+
+def test_sweep_stops_when_budget_is_spent(fake_firestore):
+    handler = _handler(fake_firestore(_docs(10)))
+
+    async def run(sweep):
+        taken = []
+        async for item_id, item in sweep.track(handler.items(), handler._cursor, budget=0.05):
+            taken.append(item_id)
+            await asyncio.sleep(0.03)
+        return taken
+
+    sweep = _Sweep()
+    taken = asyncio.run(run(sweep))
+    assert taken == ['000', '001']
+    assert not sweep.done and sweep.cursor == {'key': 1}
+    assert sweep.progress() == {'processed': 2, 'total': 2, 'done': False}
+
+
+def test_sweep_resumes_until_done(fake_firestore):
+    db = fake_firestore(_docs(10))
+    resume, calls = None, []
+    while True:
+        query = {'sync': 1, 'limit': 4, 'budget': 60} | ({'resume': resume} if resume else {})
+        _, result = _get(_handler(db, query))
+        calls.append((result['progress']['processed'], result['progress']['done']))
+        resume = result['resume']
+        if resume is None:
+            break
+    # Sweep that has reached the limit can't know it is complete, the next call finds nothing left
+    assert calls == [(4, False), (4, False), (2, True)]
+    assert len(_updated(db)) == 10
+
+
+def test_checkpoint_is_not_moved_past_failed_publishes(fake_firestore):
+    docs = _docs(10)
+    docs['docs/006']['fail'] = True
+    db = fake_firestore(docs)
+    checkpoint = _handler(db).checkpoint_document().path
+
+    status, result = _get(_handler(db, {'checkpoint': 1, 'limit': 4}, publisher=FakePublisher()))
+    assert status == 200 and db.docs[checkpoint]['processed'] == 4
+
+    # 004-007 are published but 006 failed, so the next call repeats them
+    status, result = _get(_handler(db, {'checkpoint': 1, 'limit': 4}, publisher=FakePublisher()))
+    assert status == 503 and result['failed'] == 1
+    assert result['resume'] == db.docs[checkpoint]['resume']
+    assert _Sweep.from_token(result['resume']).cursor == {'key': 3}
+
+    docs['docs/006'].pop('fail')
+    publisher = FakePublisher()
+    status, result = _get(_handler(db, {'checkpoint': 1}, publisher=publisher))
+    assert status == 200 and result['progress']['done'] and checkpoint not in db.docs
+    assert [a['item_id'] for _, a in publisher.published] == ['004', '005', '006', '007', '008', '009']
+
+
+def test_shared_dedup_acks_only_completed_messages(fake_firestore):
+    db = fake_firestore()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db.docs['dedup/done'] = {'done': True, 'started': now}
+    db.docs['dedup/running'] = {'done': False, 'started': now}
+    db.docs['dedup/abandoned'] = {'done': False, 'started': now - datetime.timedelta(hours=1)}
+    handler = _handler(db, dedup_collection='dedup')
+
+    async def run():
+        assert await handler._claim_message('new') is True
+        assert await handler._claim_message('done') is False
+        assert await handler._claim_message('abandoned') is True
+        with pytest.raises(HTTPError) as e:
+            await handler._claim_message('running')
+        assert e.value.status_code == 409
+        # Local memory doesn't keep the message of another instance
+        assert 'running' not in handler._message_ids
+        with pytest.raises(HTTPError):
+            await handler._claim_message('new')
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("keys, query", [
+    ([0, 1, 2, 3, 3, 3, 3, 4, 5, 6, 6, 7, 8], {'range_size': 3}),
+    ([0, 1, 2, 3, 3, 3, 3, 4, 5, 6, 6, 7, 8], {'shards': 4}),
+    ([0, 0, 0, 0, 1, 2], {'range_size': 2}),
+])
+def test_ranges_cover_every_document_once(keys, query, fake_firestore):
+    db = fake_firestore({f'docs/{i:03}': {'key': k} for i, k in enumerate(keys)})
+    publisher = FakePublisher()
+    status, result = _get(_handler(db, query, publisher=publisher, page_size=4))
+    assert status == 200 and result['published'] == len(publisher.published)
+
+    shards = [json.loads(a['shard']) for _, a in publisher.published]
+    starts = [s['start'] for s in shards]
+    assert starts[0] is None and shards[-1]['end'] is None
+    assert all(s['end'] == n['start'] for s, n in zip(shards, shards[1:]))
+    assert all(s['start'] is None or s['end'] is None or s['start'] < s['end'] for s in shards)
+
+    updated = []
+
+    async def update_one(self, item_id, item, **kwargs):
+        updated.append(item_id)
+
+    async def run():
+        for _, attributes in publisher.published:
+            await _handler(db, update_one=update_one).process_message(attributes)
+
+    asyncio.run(run())
+    assert sorted(updated) == sorted(f'{i:03}' for i in range(len(keys)))
+    # Every range has at least one document
+    assert all(any((s['start'] is None or s['start'] <= k) and (s['end'] is None or k < s['end']) for k in keys)
+               for s in shards)
+
+
+def _aged_docs():
+    """
+    Fresh, stale and unmarked documents, ages are in hours
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ages = {0: 30, 1: 1, 2: 50, 3: None, 4: 20, 5: 50}
+    return {
+        f'docs/{i:03}': {'key': i} | ({'updated': {'docs-update': now - datetime.timedelta(hours=age)}} if age else {})
+        for i, age in ages.items()
+    }
+
+
+def test_stale_sweep_takes_only_stale_documents_oldest_first(fake_firestore):
+    db, updated = fake_firestore(_aged_docs()), []
+
+    async def update_one(self, item_id, item, **kwargs):
+        updated.append(item_id)
+
+    status, result = _get(_handler(db, {'sync': 1, 'stale': 1, 'concurrency': 1}, update_one=update_one))
+    assert status == 200
+    # Ties in staleness are ordered by order_by, unmarked 003 is left for backfill
+    assert updated == ['002', '005', '000', '004']
+
+
+def test_stale_sweep_resumes_from_its_cursor(fake_firestore):
+    db, resume, published = fake_firestore(_aged_docs()), None, []
+    while True:
+        query = {'stale': 1, 'limit': 2, 'budget': 60} | ({'resume': resume} if resume else {})
+        publisher = FakePublisher()
+        status, result = _get(_handler(db, query, publisher=publisher))
+        assert status == 200
+        published += [a['item_id'] for _, a in publisher.published]
+        resume = result['resume']
+        if resume is None:
+            break
+    assert published == ['002', '005', '000', '004']
+
+
+def test_backfill_marks_only_unmarked_documents(fake_firestore):
+    docs = _aged_docs()
+    db = fake_firestore(docs)
+    status, result = _get(_handler(db, {'backfill': 1}))
+    assert status == 200 and result['scanned'] == 6
+    assert db.docs['docs/003']['updated']['docs-update'] == START_OF_EPOCH
+    assert all(db.docs[p] == docs[p] for p in docs if p != 'docs/003')
+
+
+def test_staleness_indexes(tmp_path):
+    # baski.infra asks for the project on import, the module itself doesn't need it
+    spec = importlib.util.spec_from_file_location(
+        'infra_firestore', Path(__file__).parents[2] / 'baski' / 'infra' / 'firestore.py')
+    infra_firestore = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(infra_firestore)
+
+    other = type('OtherHandler', (DocHandler,), {'collection_name': 'others', 'topic_id': 'others-update'})
+    file_path = tmp_path / 'firestore.indexes.json'
+    infra_firestore.dump_staleness_indexes([DocHandler, other, DocHandler], file_path)
+    assert json.loads(file_path.read_text()) == {
+        "indexes": [
+            {
+                "collectionGroup": "docs",
+                "queryScope": "COLLECTION",
+                "fields": [
+                    {"fieldPath": "updated.`docs-update`", "order": "ASCENDING"},
+                    {"fieldPath": "key", "order": "ASCENDING"},
+                ]
+            },
+            {
+                "collectionGroup": "others",
+                "queryScope": "COLLECTION",
+                "fields": [
+                    {"fieldPath": "updated.`others-update`", "order": "ASCENDING"},
+                    {"fieldPath": "key", "order": "ASCENDING"},
+                ]
+            },
+        ],
+        "fieldOverrides": []
+    }
+
+
+def test_sweep_is_resumed_only_in_its_mode(fake_firestore):
+    db = fake_firestore(_aged_docs())
+    status, result = _get(_handler(db, {'sync': 1, 'limit': 2, 'budget': 60}))
+    assert status == 200 and result['resume']
+
+    with pytest.raises(HTTPError) as e:
+        _get(_handler(db, {'sync': 1, 'stale': 1, 'resume': result['resume']}))
+    assert e.value.status_code == 400 and 'stale=0' in e.value.log_message
+
+    # Checkpoints of full and stale sweeps don't overwrite each other
+    _get(_handler(db, {'sync': 1, 'limit': 2, 'checkpoint': 1}))
+    _get(_handler(db, {'sync': 1, 'stale': 1, 'limit': 1, 'checkpoint': 1}))
+    handler = _handler(db)
+    assert _Sweep.from_token(db.docs[handler.checkpoint_document().path]['resume']).cursor == {'key': 1}
+    stale = _Sweep.from_token(db.docs[handler.checkpoint_document(stale=True).path]['resume'])
+    assert stale.stale and stale.cursor['key'] == 2
+
+
+@pytest.mark.parametrize("sync", [0, 1])
+def test_bad_cursor_is_answered_400(sync, fake_firestore):
+    handler = _handler(fake_firestore(_docs(3)), publisher=FakePublisher())
+    with pytest.raises(HTTPError) as e:
+        handler.items(skip=2000)
+    assert e.value.status_code == 400
+
+    # Cursor without the order_by field is rejected by firestore when the first page is read
+    resume = _Sweep({'other': 1}).token()
+    with pytest.raises(HTTPError) as e:
+        _get(_handler(fake_firestore(_docs(3)), {'sync': sync, 'resume': resume}, publisher=FakePublisher()))
+    assert e.value.status_code == 400
+
+
+def test_update_concurrency_is_clamped(fake_firestore):
+    running, peak = 0, 0
+
+    async def update_one(self, item_id, item, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    db = fake_firestore(_docs(10))
+    status, result = _get(_handler(db, {'sync': 1, 'concurrency': 1000}, update_one=update_one,
+                                   max_update_concurrency=3))
+    assert status == 200 and peak == 3
+    assert len(_updated(db)) == 10
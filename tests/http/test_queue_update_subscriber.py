@@ -0,0 +1,197 @@
+import asyncio
+import json
+import threading
+
+import pytest
+from tornado.web import HTTPError
+
+from baski.http import QueueUpdateHandler, QueueUpdateSubscriber
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, reference, data, merge=False):
+        self.writes.append((reference, data))
+
+    async def commit(self):
+        self.db.committed.extend(self.writes)
+
+
+class FakeDb:
+    project = 'test'
+
+    def __init__(self):
+        self.committed = []
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def collection(self, name):
+        return self
+
+    def document(self, item_id):
+        return item_id
+
+
+class FakeMessage:
+    def __init__(self, message_id, data=None, **attributes):
+        self.message_id = message_id
+        self.data = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.attributes = attributes
+        self.result = None
+
+    def ack(self):
+        self.result = 'ack'
+
+    def nack(self):
+        self.result = 'nack'
+
+
+class FakeStreamingPull:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeSubscriber:
+    def __init__(self):
+        self.callback = None
+        self.streaming_pull = FakeStreamingPull()
+
+    def subscribe(self, subscription, callback, flow_control=None):
+        self.callback = callback
+        return self.streaming_pull
+
+    def deliver(self, message):
+        # Real subscriber calls back from its own thread
+        thread = threading.Thread(target=self.callback, args=(message,))
+        thread.start()
+        thread.join()
+
+
+class EchoHandler(QueueUpdateHandler):
+    what = 'echo'
+    collection_name = 'echo'
+    topic_id = 'echo-update'
+    order_by = 'id'
+    publisher = None
+
+    db = FakeDb()
+    updated = []
+
+    async def update_one(self, item_id, item, **kwargs):
+        if item.get('fail'):
+            raise HTTPError(418, 'upstream timeout')
+        self.updated.append(item_id)
+        return {'echoed': 1}
+
+
+async def _wait_for(messages):
+    for _ in range(100):
+        if all(m.result for m in messages):
+            return
+        await asyncio.sleep(0.01)
+
+
+def test_ack_and_nack():
+    async def run():
+        subscriber = FakeSubscriber()
+        runner = QueueUpdateSubscriber(EchoHandler, 'projects/test/subscriptions/echo', subscriber=subscriber)
+        runner.start(asyncio.get_running_loop())
+        ok = FakeMessage('1', {'id': 'A'}, item_id='A')
+        failed = FakeMessage('2', {'id': 'B', 'fail': True}, item_id='B')
+        invalid = FakeMessage('3', {'id': 'C'}, item_id='C', unknown='1')
+        for message in (ok, failed, invalid):
+            subscriber.deliver(message)
+        await _wait_for([ok, failed, invalid])
+        return runner, subscriber, ok, failed, invalid
+
+    runner, subscriber, ok, failed, invalid = asyncio.run(run())
+    assert (ok.result, failed.result, invalid.result) == ('ack', 'nack', 'nack')
+    assert EchoHandler.updated == ['A']
+    assert [ref for ref, _ in EchoHandler.db.committed] == ['A']
+    assert runner.metrics['echoed'] == 1 and runner.metrics['nacked'] == 2
+
+
+@pytest.mark.parametrize("in_flight", [0, 1])
+def test_stop_drains(in_flight):
+    async def run():
+        subscriber = FakeSubscriber()
+        runner = QueueUpdateSubscriber(EchoHandler, 'projects/test/subscriptions/echo', subscriber=subscriber)
+        runner.start(asyncio.get_running_loop())
+        messages = [FakeMessage(str(i), {'id': str(i)}, item_id=str(i)) for i in range(in_flight)]
+        for message in messages:
+            subscriber.deliver(message)
+        await asyncio.sleep(0)
+        runner.stop()
+        late = FakeMessage('late', {'id': 'late'}, item_id='late')
+        subscriber.deliver(late)
+        await _wait_for(messages)
+        return subscriber, messages, late
+
+    subscriber, messages, late = asyncio.run(run())
+    assert all(m.result == 'ack' for m in messages)
+    assert late.result == 'nack'
+    assert subscriber.streaming_pull.cancelled
+
+
+def test_redelivery_is_duplicate():
+    async def run():
+        subscriber = FakeSubscriber()
+        runner = QueueUpdateSubscriber(EchoHandler, 'projects/test/subscriptions/echo', subscriber=subscriber)
+        runner.start(asyncio.get_running_loop())
+        first = FakeMessage('dup', {'id': 'D'}, item_id='D')
+        subscriber.deliver(first)
+        await _wait_for([first])
+        again = FakeMessage('dup', {'id': 'D'}, item_id='D')
+        subscriber.deliver(again)
+        await _wait_for([again])
+        return runner, first, again
+
+    runner, first, again = asyncio.run(run())
+    assert (first.result, again.result) == ('ack', 'ack')
+    assert EchoHandler.updated.count('D') == 1
+    assert runner.metrics['duplicate'] == 1
+
+
+class GatedHandler(EchoHandler):
+    gate = None
+    attempts = []
+
+    async def update_one(self, item_id, item, **kwargs):
+        self.attempts.append(item_id)
+        if len(self.attempts) == 1:
+            await self.gate.wait()
+            raise HTTPError(418, 'upstream timeout')
+        return {'echoed': 1}
+
+
+def test_duplicate_of_message_in_progress_is_redelivered():
+    async def run():
+        GatedHandler.gate = asyncio.Event()
+        subscriber = FakeSubscriber()
+        runner = QueueUpdateSubscriber(GatedHandler, 'projects/test/subscriptions/echo', subscriber=subscriber)
+        runner.start(asyncio.get_running_loop())
+        original = FakeMessage('gated', {'id': 'G'}, item_id='G')
+        duplicate = FakeMessage('gated', {'id': 'G'}, item_id='G')
+        subscriber.deliver(original)
+        await asyncio.sleep(0.01)
+        subscriber.deliver(duplicate)
+        await _wait_for([duplicate])
+        GatedHandler.gate.set()
+        await _wait_for([original])
+        # Both deliveries were nacked, so the message comes back and is processed
+        again = FakeMessage('gated', {'id': 'G'}, item_id='G')
+        subscriber.deliver(again)
+        await _wait_for([again])
+        return runner, original, duplicate, again
+
+    runner, original, duplicate, again = asyncio.run(run())
+    assert (original.result, duplicate.result, again.result) == ('nack', 'nack', 'ack')
+    assert GatedHandler.attempts == ['G', 'G']
+    assert runner.metrics['duplicate'] == 0
@@ -0,0 +1,50 @@
+import asyncio
+
+from aiohttp import web
+
+from baski.http import HttpClient, ResponseCache
+
+
+def test_cache_hit_and_revalidation(tmp_path, serve, run_http):
+    requests = []
+
+    async def handler(request):
+        requests.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304, headers={'ETag': '"v1"'})
+        return web.json_response({'value': 1}, headers={'ETag': '"v1"'})
+
+    async def main():
+        async with serve(handler) as base_url:
+            client = HttpClient(base_url, cache=ResponseCache(ttl=0.1, directory=tmp_path))
+            assert await client.fetch('/item') == {'value': 1}
+            assert await client.fetch('/item') == {'value': 1}
+            await asyncio.sleep(0.15)
+            assert await client.fetch('/item') == {'value': 1}
+            assert dict(client.cache.stats[base_url]) == {'miss': 1, 'hit': 1, 'revalidated': 1}
+
+            restarted = HttpClient(base_url, cache=ResponseCache(ttl=0.1, directory=tmp_path))
+            assert await restarted.fetch('/item') == {'value': 1}
+            assert dict(restarted.cache.stats[base_url]) == {'hit': 1}
+
+    run_http(main())
+    assert requests == [None, '"v1"']
+
+
+def test_hedged_fetch_is_cached_and_revalidated(tmp_path, serve, run_http):
+    async def handler(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304, headers={'ETag': '"v1"'})
+        return web.json_response({'value': 1}, headers={'ETag': '"v1"'})
+
+    async def main():
+        async with serve(handler) as base_url:
+            # Responses come before the hedge delay, so no hedge is sent
+            client = HttpClient(base_url, cache=ResponseCache(ttl=0.1, directory=tmp_path))
+            assert await client.fetch('/item', hedge=5.0) == {'value': 1}
+            assert await client.fetch('/item', hedge=5.0) == {'value': 1}
+            await asyncio.sleep(0.15)
+            assert await client.fetch('/item', hedge=5.0) == {'value': 1}
+            assert dict(client.cache.stats[base_url]) == {'miss': 1, 'hit': 1, 'revalidated': 1}
+
+    run_http(main())
@@ -0,0 +1,24 @@
+import pytest
+
+from baski.http import HttpClient, HttpServerError, StandInServer
+
+
+def test_record_and_replay(tmp_path, run_http):
+    async def main():
+        async with StandInServer(size=256, seed=1) as upstream_url:
+            async with StandInServer(fixtures=tmp_path, upstream=upstream_url) as recorder:
+                recorded = await HttpClient(recorder).fetch('/quote', ticker='AAPL')
+
+        replay = StandInServer(fixtures=tmp_path)
+        async with replay as base_url:
+            assert await HttpClient(base_url).fetch('/quote', ticker='AAPL') == recorded
+        assert replay.stats['replayed'] == 1
+
+        async with StandInServer(size=256, error_rate=1.0) as base_url:
+            with pytest.raises(HttpServerError):
+                await HttpClient(base_url).fetch('/quote')
+        return recorded
+
+    recorded = run_http(main())
+    assert recorded['path'] == '/quote'
+    assert len(list(tmp_path.glob('*.json'))) == 1
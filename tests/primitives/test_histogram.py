@@ -0,0 +1,26 @@
+import random
+
+from baski.primitives.histogram import Histogram
+
+
+def test_percentiles_within_precision():
+    histogram = Histogram(precision=64)
+    values = [random.lognormvariate(-3, 1.5) for _ in range(10000)]
+    for v in values:
+        histogram.record(v)
+    values.sort()
+    for q in (50, 90, 99):
+        exact = values[int(len(values) * q / 100) - 1]
+        assert abs(histogram.percentile(q) / exact - 1) < 2 / 64
+    assert histogram.count == len(values)
+    assert histogram.max == values[-1]
+
+
+def test_merge():
+    a, b = Histogram(resolution=1), Histogram(resolution=1)
+    a.record(10)
+    b.record(1000, count=3)
+    a.merge(b)
+    assert a.count == 4 and a.max == 1000
+    assert a.percentile(25) == 11
+    assert a.percentile(50) == 1000
@@ -0,0 +1,41 @@
+from baski.primitives.lru import LruCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_evicts_least_recently_used():
+    cache = LruCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+
+def test_ttl_expiration():
+    clock = Clock()
+    cache = LruCache(maxsize=10, ttl=10, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=100)
+    clock.now = 50
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert len(cache) == 1
+
+
+def test_weight_eviction():
+    cache = LruCache(maxsize=10, maxweight=100)
+    cache.set('a', 'a', weight=60)
+    cache.set('b', 'b', weight=30)
+    cache.set('c', 'c', weight=20)
+    assert 'a' not in cache
+    assert cache.weight == 50
+    cache.set('b', 'b', weight=10)
+    assert cache.weight == 30
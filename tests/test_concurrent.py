@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from baski.concurrent import PrioritySemaphore, RateLimiter, gather_or_cancel
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter_burst():
+    clock = Clock()
+    limiter = RateLimiter(rate=10, burst=3, clock=clock)
+    assert [round(limiter.reserve(), 3) for _ in range(5)] == [0, 0, 0, 0.1, 0.2]
+    clock.now += 1
+    assert limiter.reserve() == 0
+
+
+def test_rate_limiter_try_acquire():
+    clock = Clock()
+    limiter = RateLimiter(rate=1, clock=clock)
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    clock.now += 1
+    assert limiter.try_acquire()
+
+
+def test_rate_limiter_fifo():
+    async def run():
+        limiter = RateLimiter(rate=100)
+        order = []
+
+        async def call(i):
+            await limiter.acquire()
+            order.append(i)
+
+        await asyncio.gather(*[call(i) for i in range(10)])
+        return order, limiter.stats()
+
+    order, stats = asyncio.run(run())
+    assert order == list(range(10))
+    assert stats['acquired'] == 10 and stats['delayed'] == 9
+
+
+def test_rate_limiter_shared():
+    assert RateLimiter.shared('example.com', 5) is RateLimiter.shared('example.com', 5)
+    assert RateLimiter.shared('example.com', 5) is not RateLimiter.shared('example.org', 5)
+
+
+def test_gather_or_cancel_first_error():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fail():
+        raise KeyError('boom')
+
+    with pytest.raises(KeyError):
+        asyncio.run(gather_or_cancel([slow(), fail()]))
+    assert cancelled == [True]
+
+
+def test_priority_semaphore_order():
+    async def main():
+        semaphore = PrioritySemaphore(1)
+        order = []
+
+        async def worker(name, priority):
+            async with semaphore.slot(priority):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        await semaphore.acquire()
+        tasks = [asyncio.ensure_future(worker(n, p)) for n, p in [('batch', 10), ('interactive', 0), ('batch2', 10)]]
+        await asyncio.sleep(0)
+        assert semaphore.waiting == 3
+        semaphore.release()
+        await asyncio.gather(*tasks)
+        assert order == ['interactive', 'batch', 'batch2']
+        assert semaphore.in_use == 0
+
+    asyncio.run(main())